@@ -3,12 +3,27 @@ import py4web
 
 assert py4web.check_compatible("0.1.20190709.1")
 
+# times the phases of the startup, see startup.py
+from . import startup
+
 # by importing db you expose it to the _dashboard/dbadmin
 from .models import db
 
 # by importing controllers you expose the actions defined in it
 from . import controllers, htmx
 
+startup.mark("controllers")
+
+# builds the search indexes and starts the background job workers of the
+# web process, see search.py and jobs.py
+from .search import build_when_served
+from .jobs import start_web_workers
+
+build_when_served()
+startup.mark("search index")
+start_web_workers()
+startup.log_report()
+
 # optional parameters
 __version__ = "0.0.0"
 __author__ = "you <you@example.com>"
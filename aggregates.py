@@ -0,0 +1,94 @@
+"""
+Cached per parent aggregates shown by the grids: the number of orders of a
+customer and their total, the number of lines of an order and their total
+
+Values are stored in common.cache under a key holding the version of the
+parent record; the order/order_line write hooks bump the versions of the
+parents they touch once the write commits (see transactions.py), so the
+next read recomputes just those, and the transaction doing the write reads
+them without the cache. As with fragments.py versions are per process,
+writes done by other processes are picked up when the entries expire
+(AGGREGATE_CACHE_TTL).
+
+The data_version counters of versions.py are bumped in the transaction
+itself: they are rows committed (or rolled back) with the write, so no
+reader sees the new counter before the new rows.
+"""
+
+import threading
+from collections import defaultdict
+
+from .common import cache, db, settings
+from . import versions as data_versions
+from .transactions import on_commit, pending, uncommitted
+
+_lock = threading.Lock()
+versions = defaultdict(int)
+
+
+def invalidate(tablename, *parent_ids):
+    """bump the versions of the parent_ids of tablename, once the write commits"""
+    parent_ids = [int(i) for i in parent_ids if i is not None]
+    pending("aggregates").update((tablename, i) for i in parent_ids)
+    #  and the shared counters the ETags of the fragments are made of
+    data_versions.bump(*["%s/%s" % (tablename, i) for i in parent_ids])
+
+
+@on_commit("aggregates")
+def bump_committed(keys):
+    with _lock:
+        for key in keys:
+            versions[key] += 1
+
+
+def track_parents(table, fieldname):
+    """invalidate the aggregates of the fieldname parents table writes touch"""
+    tablename = table._tablename
+    field = table[fieldname]
+
+    def parents_of(s):
+        return [row[field] for row in db(s.query).select(field, distinct=True)]
+
+    def before_update(s, fields):
+        #  a row moved to another parent changes the old one too
+        if fieldname in fields:
+            invalidate(tablename, *parents_of(s))
+
+    def after_update(s, fields):
+        invalidate(tablename, fields.get(fieldname), *parents_of(s))
+
+    def before_delete(s):
+        invalidate(tablename, *parents_of(s))
+
+    table._after_insert.append(lambda f, i: invalidate(tablename, f.get(fieldname)))
+    table._before_update.append(before_update)
+    table._after_update.append(after_update)
+    table._before_delete.append(before_delete)
+
+
+def aggregate(table, fieldname, parent_id, sum_field):
+    """(count, sum of sum_field) of the rows of table whose fieldname is parent_id"""
+    count, total = table.id.count(), sum_field.sum()
+
+    def compute():
+        row = db(table[fieldname] == parent_id).select(count, total).first()
+        return row[count], row[total]
+
+    if not settings.AGGREGATE_CACHE_TTL or not parent_id:
+        return compute()
+    parent_id = int(parent_id)
+    if (table._tablename, parent_id) in uncommitted("aggregates"):
+        return compute()
+    key = ("aggregate", table._tablename, parent_id)
+    version = versions[(table._tablename, parent_id)]
+    return cache.get(key + (version,), compute, settings.AGGREGATE_CACHE_TTL)
+
+
+def customer_order_totals(customer_id):
+    """(number of orders, their total) of customer_id"""
+    return aggregate(db.order, "customer", customer_id, db.order.total)
+
+
+def order_line_totals(order_id):
+    """(number of lines, their total) of order_id"""
+    return aggregate(db.order_line, "order", order_id, db.order_line.price)
@@ -0,0 +1,50 @@
+"""
+Benchmarks for the app, run from the folder containing apps/, e.g.:
+
+    python -m apps.htmx_demo.benchmarks.order_line_delete
+
+They work inside a transaction on the configured database and roll it back
+when done, so storage.db is left untouched.
+"""
+
+import threading
+import time
+
+from pydal.helpers.classes import ExecutionHandler
+
+from ..common import db
+
+_counters = threading.local()
+
+
+class StatementCounter(ExecutionHandler):
+    """pydal execution handler counting the statements of the current thread"""
+
+    def after_execute(self, command):
+        _counters.count = getattr(_counters, "count", 0) + 1
+
+
+db._adapter.execution_handlers.append(StatementCounter)
+
+
+class measure:
+    """context manager recording the statements and seconds spent in its block"""
+
+    def __enter__(self):
+        self.start_count = getattr(_counters, "count", 0)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start_time
+        self.statements = getattr(_counters, "count", 0) - self.start_count
+
+
+def insert_order_lines(order_id, product, count):
+    """insert count lines without running the order_line hooks"""
+    for _ in range(count):
+        db.executesql(
+            db.order_line._insert(
+                order=order_id, product=product.id, quantity=1, price=product.price
+            )
+        )
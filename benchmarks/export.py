@@ -0,0 +1,158 @@
+"""
+Streaming exports through the WSGI app, at up to a million order lines:
+
+    python -m apps.htmx_demo.benchmarks.export [--seed] [--orders 100000]
+        [--lines 1000000] [--format csv] [--exports orders,order_lines]
+        [--compare]
+
+With --seed the configured database is topped up as by benchmarks/load.py
+(and committed), so run it on a throwaway copy of the app. Every export is
+requested once and read chunk by chunk, printing the rows and bytes sent per
+second, the time to the first chunk and the peak of the memory allocated
+while streaming (tracemalloc, which slows everything down). --compare also
+times the same rows selected at once into pydal Rows and written out in one
+string, as an action returning the whole file would.
+"""
+
+import argparse
+import importlib
+import io
+import random
+import sys
+import time
+import tracemalloc
+
+from .load import load_app, seed
+
+EXPORTS = ["orders", "order_lines"]
+
+
+def stream(app, path, query):
+    """iterate the export response, returns (status, bytes, first chunk s)"""
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+    }
+    status, size, first = [], 0, None
+    start = time.perf_counter()
+    body = app(environ, lambda s, headers, exc=None: status.append(s))
+    try:
+        for chunk in body:
+            if first is None:
+                first = time.perf_counter() - start
+            size += len(chunk)
+    finally:
+        getattr(body, "close", lambda: None)()
+    return int(status[0].split()[0]), size, first
+
+
+def select_at_once(package, name):
+    """the whole export in memory, as without streaming; returns its size"""
+    db, export = package.models.db, package.export
+    if name == "orders":
+        columns, query = export.order_columns(), export.order_query()
+        left = db.customer.on(db.order.customer == db.customer.id)
+    else:
+        columns, query = export.order_line_columns(), export.order_line_query()
+        left = db.product.on(db.order_line.product == db.product.id)
+    rows = db(query).select(*[field for heading, field in columns], left=left)
+    buffer = io.StringIO()
+    rows.export_to_csv_file(buffer)
+    return len(buffer.getvalue().encode())
+
+
+def measured(func, *args):
+    """(result, seconds, peak MB allocated) of func(*args)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="export")
+    parser.add_argument("--seed", action="store_true", help="top up the tables")
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--lines", type=int, default=1000000)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--exports", help="comma separated, default all")
+    parser.add_argument("--compare", action="store_true", help="also select at once")
+    parser.add_argument("--random-seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    app, package = load_app()
+    db = package.models.db
+    importlib.import_module(package.__name__ + ".export")
+    if args.seed:
+        volumes = seed(
+            package,
+            args.customers,
+            args.products,
+            args.orders,
+            args.lines,
+            random.Random(args.random_seed),
+        )
+    else:
+        volumes = dict(orders=db(db.order).count(), lines=db(db.order_line).count())
+    db.commit()
+    print(
+        "volumes: %s, chunks of %s rows" % (volumes, package.settings.EXPORT_CHUNK_SIZE)
+    )
+
+    rows = dict(orders=volumes["orders"], order_lines=volumes["lines"])
+    print(
+        "%-12s %-9s %8s %10s %9s %10s %9s"
+        % ("export", "mode", "seconds", "rows/s", "MB", "first ms", "peak MB")
+    )
+    for name in args.exports.split(",") if args.exports else EXPORTS:
+        path = "/%s/export/%s" % (package.__name__.split(".")[1], name)
+        (status, size, first), seconds, peak = measured(
+            stream, app, path, "format=" + args.format
+        )
+        if status != 200:
+            raise SystemExit("%s answered %s" % (path, status))
+        print(
+            "%-12s %-9s %8.2f %10.0f %9.1f %10.1f %9.1f"
+            % (
+                name,
+                "stream",
+                seconds,
+                rows[name] / seconds,
+                size / 2**20,
+                first * 1000,
+                peak,
+            )
+        )
+        if args.compare:
+            size, seconds, peak = measured(select_at_once, package, name)
+            db.rollback()
+            print(
+                "%-12s %-9s %8.2f %10.0f %9.1f %10s %9.1f"
+                % (
+                    name,
+                    "at once",
+                    seconds,
+                    rows[name] / seconds,
+                    size / 2**20,
+                    "-",
+                    peak,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
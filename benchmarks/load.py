@@ -0,0 +1,349 @@
+"""
+Load test of the htmx endpoints, run in-process through the WSGI app:
+
+    python -m apps.htmx_demo.benchmarks.load [--seed] [--customers 1000]
+        [--products 5000] [--orders 5000] [--lines 20000]
+        [--clients 8] [--requests 200] [--out results.json]
+        [--compare previous.json]
+
+With --seed the configured database (storage.db) is topped up to the given
+volumes with reproducible random data, so run it on a throwaway copy of the
+app. Every scenario is then requested by --clients concurrent threads and
+the p50/p95/p99 latency, requests/s, response size and SQL statements per
+request are printed and written as json (by default to
+benchmarks/results/<date>-<commit>.json) to compare runs across commits.
+
+Unlike the other benchmarks this one commits what it seeds.
+"""
+
+import argparse
+import datetime
+import importlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+APP_NAME = __package__.split(".")[1]
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS_FOLDER = os.path.dirname(APP_FOLDER)
+WORDS = (
+    "ale lager stout porter pils ipa imperial double amber red pale brown "
+    "golden wheat session hazy sour gose saison tripel dubbel bock oatmeal"
+).split()
+
+
+def load_app():
+    """
+    the WSGI app and the app package, loaded by py4web; the modules imported
+    to run this one are dropped first, else py4web would reuse them without
+    registering the actions
+    """
+    from py4web.core import wsgi
+
+    for name in list(sys.modules):
+        if name == "apps" or name.startswith("apps."):
+            del sys.modules[name]
+    os.environ["PY4WEB_APP_NAMES"] = APP_NAME
+    app = wsgi(apps_folder=APPS_FOLDER)
+    return app, importlib.import_module("apps.%s" % APP_NAME)
+
+
+def seed(package, customers, products, orders, lines, rnd):
+    """add rows until every table holds the requested number of them"""
+    db = package.models.db
+    now = datetime.datetime.now().replace(microsecond=0)
+    insert_many = importlib.import_module(package.__name__ + ".importer").insert_many
+
+    def top_up(table, count, make):
+        missing = count - db(table).count()
+        if missing > 0:
+            for start in range(0, missing, 10000):
+                n = min(10000, missing - start)
+                insert_many(table, [make() for _ in range(n)])
+        return [r[0] for r in db.executesql(db(table)._select(table.id))]
+
+    customer_ids = top_up(
+        db.customer,
+        customers,
+        lambda: dict(
+            name="%s %s" % (rnd.choice(WORDS).title(), rnd.randint(1, 10**6)),
+            city=rnd.choice(WORDS),
+            state="WI",
+        ),
+    )
+    product_ids = top_up(
+        db.product,
+        products,
+        lambda: dict(
+            name=" ".join(rnd.choice(WORDS) for _ in range(3)),
+            price="%.2f" % rnd.uniform(1, 50),
+        ),
+    )
+    order_ids = top_up(
+        db.order,
+        orders,
+        lambda: dict(
+            customer=rnd.choice(customer_ids),
+            total=0,
+            created_on=now - datetime.timedelta(minutes=rnd.randint(0, 10**6)),
+        ),
+    )
+    top_up(
+        db.order_line,
+        lines,
+        lambda: dict(
+            order=rnd.choice(order_ids),
+            product=rnd.choice(product_ids),
+            quantity=rnd.randint(1, 5),
+            price=0,
+        ),
+    )
+    #  rows were inserted without the hooks, derive what they maintain
+    db.executesql(
+        "UPDATE order_line SET price = quantity * "
+        "(SELECT price FROM product WHERE product.id = order_line.product) "
+        "WHERE price = 0;"
+    )
+    package.totals.rebuild_order_totals()
+    package.summaries.rebuild_customer_summaries()
+    package.fragments.bump("product", "customer", "order", "order_line")
+    db.commit()
+    package.search.invalidate("product")
+    return dict(
+        customers=db(db.customer).count(),
+        products=db(db.product).count(),
+        orders=db(db.order).count(),
+        lines=db(db.order_line).count(),
+    )
+
+
+def scenarios(db, rnd):
+    """name -> function returning (method, path, query, body) of one request"""
+    max_id = lambda table: db(table).select(table.id.max()).first()[table.id.max()]
+    customers, orders = max_id(db.customer) or 1, max_id(db.order) or 1
+    app = "/" + APP_NAME
+    form = "tablename=order_line&fieldname=product&order_id=%s&%s"
+    return {
+        "customers": lambda: ("GET", app + "/customers", "", b""),
+        "customer_orders": lambda: (
+            "GET",
+            app + "/customer_orders",
+            "parent_id=%s" % rnd.randint(1, customers),
+            b"",
+        ),
+        "orders": lambda: ("GET", app + "/orders", "", b""),
+        "order_lines": lambda: (
+            "GET",
+            app + "/order_lines",
+            "parent_id=%s" % rnd.randint(1, orders),
+            b"",
+        ),
+        "product_autocomplete": lambda: (
+            "POST",
+            app + "/product_autocomplete",
+            "",
+            (
+                form
+                % (
+                    rnd.randint(1, orders),
+                    "order_line_product_search=%s" % rnd.choice(WORDS)[:3],
+                )
+            ).encode(),
+        ),
+    }
+
+
+def request(app, method, path, query, body):
+    """call the WSGI app, returns (status code, response size)"""
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    if body:
+        environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+    status = []
+    size = sum(
+        len(chunk)
+        for chunk in app(environ, lambda s, headers, exc=None: status.append(s))
+    )
+    return int(status[0].split()[0]), size
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def run_scenario(app, measure, make_request, clients, count):
+    lock = threading.Lock()
+    samples = []
+
+    def one(_):
+        method, path, query, body = make_request()
+        with measure() as m:
+            status, size = request(app, method, path, query, body)
+        with lock:
+            samples.append((m.seconds * 1000, m.statements, size, status))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one, range(count)))
+    seconds = time.perf_counter() - start
+
+    latencies = sorted(s[0] for s in samples)
+    statements = [s[1] for s in samples]
+    return dict(
+        requests=count,
+        errors=sum(1 for s in samples if s[3] >= 400),
+        requests_per_second=round(count / seconds, 1),
+        p50_ms=round(percentile(latencies, 50), 2),
+        p95_ms=round(percentile(latencies, 95), 2),
+        p99_ms=round(percentile(latencies, 99), 2),
+        mean_statements=round(statistics.mean(statements), 1),
+        max_statements=max(statements),
+        mean_bytes=round(statistics.mean(s[2] for s in samples)),
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=APP_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    print("\nchange vs %s:" % previous.get("commit"))
+    for name, now in results["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        print(
+            "%-22s p95 %+7.1f%%  req/s %+7.1f%%  statements %+.1f"
+            % (
+                name,
+                (now["p95_ms"] / before["p95_ms"] - 1) * 100,
+                (now["requests_per_second"] / before["requests_per_second"] - 1) * 100,
+                now["mean_statements"] - before["mean_statements"],
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="load")
+    parser.add_argument("--seed", action="store_true", help="top up the tables")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--scenarios", help="comma separated, default all")
+    parser.add_argument("--random-seed", type=int, default=42)
+    parser.add_argument("--out", help="json file for the results")
+    parser.add_argument("--compare", help="json results of an earlier run")
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.random_seed)
+    app, package = load_app()
+    db = package.models.db
+    measure = importlib.import_module(package.__name__ + ".benchmarks").measure
+
+    if args.seed:
+        volumes = seed(
+            package, args.customers, args.products, args.orders, args.lines, rnd
+        )
+    else:
+        volumes = dict(
+            customers=db(db.customer).count(),
+            products=db(db.product).count(),
+            orders=db(db.order).count(),
+            lines=db(db.order_line).count(),
+        )
+    db.commit()
+    print("volumes: %s" % volumes)
+
+    results = dict(
+        commit=git_commit(),
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        volumes=volumes,
+        clients=args.clients,
+        scenarios={},
+    )
+    selected = scenarios(db, rnd)
+    if args.scenarios:
+        selected = {k: selected[k] for k in args.scenarios.split(",")}
+    db.commit()
+
+    print(
+        "%-22s %8s %7s %9s %9s %9s %10s %9s"
+        % (
+            "scenario",
+            "req/s",
+            "errors",
+            "p50 ms",
+            "p95 ms",
+            "p99 ms",
+            "sql/req",
+            "bytes",
+        )
+    )
+    for name, make_request in selected.items():
+        r = run_scenario(app, measure, make_request, args.clients, args.requests)
+        results["scenarios"][name] = r
+        print(
+            "%-22s %8s %7s %9s %9s %9s %10s %9s"
+            % (
+                name,
+                r["requests_per_second"],
+                r["errors"],
+                r["p50_ms"],
+                r["p95_ms"],
+                r["p99_ms"],
+                r["mean_statements"],
+                r["mean_bytes"],
+            )
+        )
+
+    out = args.out
+    if not out:
+        folder = os.path.join(APP_FOLDER, "benchmarks", "results")
+        os.makedirs(folder, exist_ok=True)
+        out = os.path.join(
+            folder,
+            "%s-%s.json"
+            % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), results["commit"]),
+        )
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print("results written to %s" % out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Statements issued when deleting 1, 100 and 10,000 lines of an order:
+
+    python -m apps.htmx_demo.benchmarks.order_line_delete [--sizes 1,100,10000]
+
+"per-row" is the original hook (a SUM, an order fetch and an update for each
+deleted line), "aggregate" and "delta" are the ORDER_TOTAL_MODE settings.
+"""
+
+import argparse
+
+from ..common import db, settings
+from ..totals import rebuild_order_totals
+from . import measure, insert_order_lines
+
+MODES = ["per-row", "aggregate", "delta"]
+
+
+def per_row_delete(s):
+    for row in db(s.query).select():
+        total = (
+            db((db.order_line.order == row.order) & (db.order_line.id != row.id))
+            .select(db.order_line.price.sum())
+            .first()[db.order_line.price.sum()]
+        )
+        order = db.order(row.order)
+        order.update_record(total=total)
+    return s.delete_naive()
+
+
+def run(size, mode, extra_lines=100):
+    customer_id = db.customer.insert(name="benchmark")
+    order_id = db.order.insert(customer=customer_id)
+    product = db(db.product.price > 0).select(limitby=(0, 1)).first()
+    if not product:
+        product = db.product(db.product.insert(name="benchmark", price=1))
+    insert_order_lines(order_id, product, size + extra_lines)
+    rebuild_order_totals()
+
+    first_id = (
+        db(db.order_line.order == order_id)
+        .select(db.order_line.id.min())
+        .first()[db.order_line.id.min()]
+    )
+    s = db((db.order_line.order == order_id) & (db.order_line.id < first_id + size))
+
+    saved_mode = settings.ORDER_TOTAL_MODE
+    try:
+        with measure() as m:
+            if mode == "per-row":
+                per_row_delete(s)
+            else:
+                settings.ORDER_TOTAL_MODE = mode
+                s.delete()
+    finally:
+        settings.ORDER_TOTAL_MODE = saved_mode
+
+    in_sync = not rebuild_order_totals(verify_only=True)
+    db.rollback()
+    return m, in_sync
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="order_line_delete")
+    parser.add_argument("--sizes", default="1,100,10000")
+    args = parser.parse_args(argv)
+
+    print(
+        "%8s %10s %12s %10s %8s" % ("lines", "mode", "statements", "seconds", "in sync")
+    )
+    for size in [int(x) for x in args.sizes.split(",")]:
+        for mode in MODES:
+            m, in_sync = run(size, mode)
+            print(
+                "%8s %10s %12s %10.4f %8s"
+                % (size, mode, m.statements, m.seconds, in_sync)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Autocomplete search latency of LIKE '%term%' vs the FTS5 and memory indexes:
+
+    python -m apps.htmx_demo.benchmarks.search [--sizes 10000,100000,1000000]
+
+Runs on a scratch in-memory SQLite database holding only a product table.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from pydal import DAL, Field
+
+from ..search import FtsIndex, PrefixIndex
+
+WORDS = (
+    "ale lager stout porter pils ipa imperial double amber red pale brown "
+    "golden wheat session hazy sour gose saison tripel dubbel bock oatmeal "
+    "spotted cow moon man hop rye barrel aged coffee cherry black white"
+).split()
+TERMS = ["i", "ip", "ipa", "spot cow", "barrel aged st", "zzz"]
+LIMIT = 15
+
+
+def make_db(size, seed=42):
+    scratch = DAL("sqlite:memory")
+    scratch.define_table("product", Field("name"), Field("price", "decimal(9,2)"))
+    fts = FtsIndex(scratch.product, ["name"])
+    fts.setup()
+    rnd = random.Random(seed)
+    rows = [
+        (" ".join(rnd.choice(WORDS) for _ in range(3)) + " %s" % n, "9.99")
+        for n in range(size)
+    ]
+    scratch._adapter.cursor.executemany(
+        "INSERT INTO product(name, price) VALUES (?, ?);", rows
+    )
+    memory = PrefixIndex(scratch.product, ["name"])
+    memory.build()
+    return scratch, fts, memory
+
+
+def timed(f, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, len(result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="search")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    args = parser.parse_args(argv)
+
+    print(
+        "%9s %16s %12s %12s %12s"
+        % ("products", "term", "like ms", "fts5 ms", "memory ms")
+    )
+    for size in [int(x) for x in args.sizes.split(",")]:
+        scratch, fts, memory = make_db(size)
+        product = scratch.product
+        for term in TERMS:
+            like_query = product.id > 0
+            for word in term.split():
+                like_query &= product.name.contains(word)
+            like, _ = timed(
+                lambda: scratch(like_query).select(
+                    product.id, product.name, limitby=(0, LIMIT)
+                )
+            )
+            full_text, _ = timed(lambda: fts.search(term, limit=LIMIT))
+            in_memory, _ = timed(lambda: memory.search(term, limit=LIMIT))
+            print(
+                "%9s %16s %12.3f %12.3f %12.3f"
+                % (size, term, like, full_text, in_memory)
+            )
+        scratch.close()
+
+
+if __name__ == "__main__":
+    main()
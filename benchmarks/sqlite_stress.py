@@ -0,0 +1,197 @@
+"""
+Concurrent reads and writes on a copy of the SQLite database:
+
+    python -m apps.htmx_demo.benchmarks.sqlite_stress [--profile settings]
+        [--writers 4] [--readers 8] [--seconds 10] [--compare]
+
+Writers change the quantity of a random order line and add the price
+difference to its order in one transaction, as the order_line hooks do.
+Readers run the queries of the order_lines grid: a page of lines with their
+product and the count and total of the order. Every operation takes a
+connection from the pool and gives it back, as a request does.
+
+--profile settings uses DB_SQLITE_PRAGMAS, DB_POOL_SIZE and run_with_retry
+(see database.py), --profile default plain SQLite and pydal (rollback
+journal, a new connection per operation, no retry); --compare runs both.
+The database is copied to a temporary folder, storage.db is left untouched.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from pydal import DAL
+
+from .. import settings
+from ..database import (
+    configure_connection,
+    is_locked,
+    run_with_retry,
+    use_connection_pool,
+)
+
+PROFILES = ["settings", "default"]
+
+
+def copy_database(folder):
+    """copy the configured sqlite database into folder, returns the uri"""
+    if not settings.DB_URI.startswith("sqlite://"):
+        raise SystemExit("the stress test needs a sqlite DB_URI")
+    source = sqlite3.connect(
+        os.path.join(settings.DB_FOLDER, settings.DB_URI.split("://", 1)[1])
+    )
+    target = sqlite3.connect(os.path.join(folder, "stress.db"))
+    source.backup(target)
+    source.close()
+    target.close()
+    return "sqlite://stress.db"
+
+
+def open_database(uri, folder, profile):
+    if profile == "settings":
+        db = DAL(uri, folder=folder, after_connection=configure_connection)
+        use_connection_pool(db, settings.DB_POOL_SIZE)
+    else:
+        db = DAL(uri, folder=folder)
+    return db
+
+
+def sample_lines(db, count=1000):
+    return db.executesql(
+        'SELECT order_line.id, order_line."order", product.price '
+        "FROM order_line JOIN product ON product.id = order_line.product "
+        "WHERE product.price > 0 ORDER BY random() LIMIT %s;" % count
+    )
+
+
+def write(db, line):
+    line_id, order_id, unit_price = line
+    quantity = random.randint(1, 9)
+    old = db.executesql("SELECT price FROM order_line WHERE id = %s;" % line_id)
+    price = round(quantity * float(unit_price), 2)
+    db.executesql(
+        "UPDATE order_line SET quantity = %s, price = %s WHERE id = %s;"
+        % (quantity, price, line_id)
+    )
+    db.executesql(
+        'UPDATE "order" SET total = COALESCE(total, 0) + %s WHERE id = %s;'
+        % (price - float(old[0][0] or 0), order_id)
+    )
+
+
+def read(db, line):
+    order_id = line[1]
+    db.executesql(
+        "SELECT order_line.id, product.name, order_line.quantity, "
+        "product.price, order_line.price FROM order_line "
+        "LEFT JOIN product ON order_line.product = product.id "
+        'WHERE order_line."order" = %s ORDER BY order_line.id LIMIT 6;' % order_id
+    )
+    db.executesql(
+        'SELECT COUNT(*), SUM(price) FROM order_line WHERE "order" = %s;' % order_id
+    )
+
+
+def client(db, profile, operation, lines, stop, results):
+    latencies, locked = [], 0
+    while not stop.is_set():
+        line = random.choice(lines)
+        start = time.perf_counter()
+        db.get_connection_from_pool_or_new()
+        try:
+            if profile == "settings":
+                run_with_retry(db, operation, db, line)
+            else:
+                operation(db, line)
+            db.recycle_connection_in_pool_or_close("commit")
+        except sqlite3.OperationalError as error:
+            db.recycle_connection_in_pool_or_close("rollback")
+            if not is_locked(error):
+                raise
+            locked += 1
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    results.append((operation.__name__, latencies, locked))
+
+
+def run(profile, writers, readers, seconds):
+    folder = tempfile.mkdtemp()
+    try:
+        uri = copy_database(folder)
+        db = open_database(uri, folder, profile)
+        lines = sample_lines(db)
+        db.commit()
+        if not lines:
+            raise SystemExit("no priced order lines to update")
+
+        stop, results, threads = threading.Event(), [], []
+        for operation, count in ((write, writers), (read, readers)):
+            for _ in range(count):
+                thread = threading.Thread(
+                    target=client, args=(db, profile, operation, lines, stop, results)
+                )
+                thread.start()
+                threads.append(thread)
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        db.close()
+
+        report = {}
+        for name in ("write", "read"):
+            latencies = sorted(
+                ms for n, values, locked in results if n == name for ms in values
+            )
+            report[name] = dict(
+                per_second=round(len(latencies) / seconds, 1),
+                locked=sum(locked for n, values, locked in results if n == name),
+                p50_ms=round(statistics.median(latencies), 2) if latencies else None,
+                p95_ms=(
+                    round(latencies[int(len(latencies) * 0.95)], 2)
+                    if latencies
+                    else None
+                ),
+            )
+        return report
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sqlite_stress")
+    parser.add_argument("--profile", choices=PROFILES, default="settings")
+    parser.add_argument("--compare", action="store_true", help="run both profiles")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args(argv)
+
+    print(
+        "%-10s %-6s %10s %8s %9s %9s"
+        % ("profile", "op", "ops/s", "locked", "p50 ms", "p95 ms")
+    )
+    for profile in PROFILES if args.compare else [args.profile]:
+        report = run(profile, args.writers, args.readers, args.seconds)
+        for name, r in report.items():
+            print(
+                "%-10s %-6s %10s %8s %9s %9s"
+                % (
+                    profile,
+                    name,
+                    r["per_second"],
+                    r["locked"],
+                    r["p50_ms"],
+                    r["p95_ms"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
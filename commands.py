@@ -0,0 +1,244 @@
+"""
+Maintenance commands for the app, run from the folder containing apps/:
+
+    python -m apps.htmx_demo.commands rebuild-totals [--verify]
+    python -m apps.htmx_demo.commands rebuild-summaries
+    python -m apps.htmx_demo.commands reprice [--products 1,2,3]
+    python -m apps.htmx_demo.commands import-products FILE [--batch-size N]
+    python -m apps.htmx_demo.commands rebuild-search
+    python -m apps.htmx_demo.commands check-indexes
+    python -m apps.htmx_demo.commands worker [--threads N] [--once]
+    python -m apps.htmx_demo.commands startup-report [--runs N] [--budget S]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .common import db, settings
+from . import totals, importer, search, summaries, jobs, tasks, models, repricing
+
+
+def rebuild_totals(args):
+    mismatched = totals.rebuild_order_totals(verify_only=args.verify)
+    for order_id, stored, actual in mismatched:
+        print("order %s: stored %s, actual %s" % (order_id, stored, actual))
+    if args.verify:
+        print("%s order totals out of sync" % len(mismatched))
+        return 1 if mismatched else 0
+    db.commit()
+    print("%s order totals fixed" % len(mismatched))
+    return 0
+
+
+def rebuild_summaries(args):
+    customers = summaries.rebuild_customer_summaries()
+    db.commit()
+    print("%s customer summaries rebuilt" % customers)
+    return 0
+
+
+def reprice(args):
+    product_ids = None
+    if args.products:
+        product_ids = [int(i) for i in args.products.split(",")]
+    lines, orders = repricing.reprice(product_ids)
+    db.commit()
+    print("%s order lines repriced, %s order totals refreshed" % (lines, orders))
+    return 0
+
+
+def import_products(args):
+    with open(args.file, newline="", encoding="utf8") as f:
+        stats = importer.import_products(
+            f, batch_size=args.batch_size, progress=lambda stats: print(stats)
+        )
+    print("done: %s" % stats)
+    return 0
+
+
+def rebuild_search(args):
+    rebuilt = search.rebuild_indexes()
+    db.commit()
+    print("%s search index rebuilt: %s" % (settings.SEARCH_BACKEND, ", ".join(rebuilt)))
+    return 0
+
+
+def check_indexes(args):
+    """EXPLAIN the queries models.INDEXES exist for, fail if one is not used"""
+    if db._dbname != "sqlite":
+        print("check-indexes only knows SQLite query plans")
+        return 1
+    models.create_indexes()
+    product = db.product
+    line = db.order_line
+    left = line.on((line.product == product.id) & (line.order == 1))
+    queries = {
+        "order_line__order_product_idx": [
+            db(line.order == 1)._select(line.product),
+            db((line.id == None) & product.name.contains("a"))._select(
+                product.id, product.name, left=left
+            ),
+        ],
+        "order__customer_idx": [db(db.order.customer == 1)._select(db.order.id)],
+        "order__created_on_idx": [
+            db(db.order.created_on >= datetime.date.today())._select(db.order.id)
+        ],
+        "product__name_idx": [
+            db(product.id > 0)._select(
+                product.id, orderby=product.name, limitby=(0, 15)
+            )
+        ],
+        "customer_summary__lifetime_total_idx": [
+            db(db.customer_summary.lifetime_total >= 100)._select(
+                db.customer_summary.customer
+            )
+        ],
+        "customer__name_idx": [
+            db(db.customer.name > "m")._select(
+                db.customer.id, orderby=[db.customer.name, db.customer.id]
+            )
+        ],
+    }
+    failures = 0
+    for index_name, statements in queries.items():
+        for sql in statements:
+            plan = " | ".join(
+                str(row[-1]) for row in db.executesql("EXPLAIN QUERY PLAN " + sql)
+            )
+            used = index_name in plan
+            failures += not used
+            print(
+                "%s %s\n    %s\n    %s"
+                % ("ok " if used else "NOT", index_name, sql, plan)
+            )
+    return 1 if failures else 0
+
+
+def worker(args):
+    if args.once:
+        print("%s jobs run" % jobs.worker.run_pending())
+        return 0
+    jobs.worker.start(args.threads)
+    try:
+        while any(thread.is_alive() for thread in jobs.worker.threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        jobs.worker.stop()
+    return 0
+
+
+#  run by startup-report in a new interpreter, from the folder containing apps/
+STARTUP_RUN = """
+import json, time
+start = time.perf_counter()
+import py4web
+loaded = time.perf_counter()
+import %s as app
+done = time.perf_counter()
+print(json.dumps(dict(py4web=loaded - start, app=done - loaded, phases=app.startup.phases)))
+"""
+
+
+def startup_report(args):
+    """
+    import the app in --runs new interpreters, print the phases of the median
+    run and fail when its import took more than --budget seconds
+    """
+    package = __package__
+    cwd = os.path.dirname(os.path.dirname(settings.APP_FOLDER))
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_RUN % package],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    runs.sort(key=lambda run: run["app"])
+    median = runs[len(runs) // 2]
+    print("%s profile, median of %s runs" % (settings.STARTUP_PROFILE, args.runs))
+    print("%-14s %8.1f ms" % ("py4web", median["py4web"] * 1000))
+    for phase, seconds in median["phases"]:
+        print("%-14s %8.1f ms" % (phase, seconds * 1000))
+    print(
+        "%-14s %8.1f ms (min %.1f, max %.1f, budget %.1f)"
+        % (
+            "app import",
+            median["app"] * 1000,
+            runs[0]["app"] * 1000,
+            runs[-1]["app"] * 1000,
+            args.budget * 1000,
+        )
+    )
+    if median["app"] > args.budget:
+        print("over budget")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser(
+        "rebuild-totals", help="reconcile order.total with the order lines"
+    )
+    p.add_argument(
+        "--verify", action="store_true", help="only report, do not fix totals"
+    )
+    p.set_defaults(func=rebuild_totals)
+
+    p = subparsers.add_parser(
+        "rebuild-summaries", help="recompute the customer_summary table"
+    )
+    p.set_defaults(func=rebuild_summaries)
+
+    p = subparsers.add_parser(
+        "reprice", help="recompute the order line prices from the product prices"
+    )
+    p.add_argument("--products", help="comma separated ids, default all")
+    p.set_defaults(func=reprice)
+
+    p = subparsers.add_parser(
+        "import-products", help="import a name,price csv into the product table"
+    )
+    p.add_argument("file")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=import_products)
+
+    p = subparsers.add_parser(
+        "rebuild-search", help="rebuild the autocomplete search indexes"
+    )
+    p.set_defaults(func=rebuild_search)
+
+    p = subparsers.add_parser(
+        "check-indexes", help="verify with EXPLAIN that the indexes are used"
+    )
+    p.set_defaults(func=check_indexes)
+
+    p = subparsers.add_parser("worker", help="run the queued background jobs")
+    p.add_argument("--threads", type=int, default=1)
+    p.add_argument("--once", action="store_true", help="run the due jobs and exit")
+    p.set_defaults(func=worker)
+
+    p = subparsers.add_parser(
+        "startup-report", help="time the import of the app in new interpreters"
+    )
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--budget", type=float, default=1.0, help="seconds, median run")
+    p.set_defaults(func=startup_report)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
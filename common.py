@@ -7,12 +7,14 @@ import os
 import sys
 import logging
 from py4web import Session, Cache, Translator, Flash, DAL, Field, action
-from py4web.utils.mailer import Mailer
 from py4web.utils.auth import Auth
-from py4web.utils.downloader import downloader
 from py4web.utils.factories import ActionFactory
 from pydal.tools.tags import Tags
-from . import settings
+from . import settings, startup
+from .database import configure_connection, use_connection_pool
+from .transactions import track_transactions
+
+startup.mark("imports")
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -38,9 +40,13 @@ db = DAL(
     settings.DB_URI,
     folder=settings.DB_FOLDER,
     pool_size=settings.DB_POOL_SIZE,
-    migrate=settings.DB_MIGRATE,
+    migrate=startup.MIGRATE,
     fake_migrate=settings.DB_FAKE_MIGRATE,
+    after_connection=configure_connection,
 )
+use_connection_pool(db, settings.DB_POOL_SIZE)
+track_transactions(db._adapter)
+startup.mark("connect")
 
 # #######################################################
 # define global objects that may or may not be used by the actions
@@ -75,6 +81,7 @@ elif settings.SESSION_TYPE == "database":
     from py4web.utils.dbstore import DBStore
 
     session = Session(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
+startup.mark("session")
 
 # #######################################################
 # Instantiate the object and actions that handle auth
@@ -88,11 +95,14 @@ auth.param.login_expiration_time = 3600
 auth.param.password_complexity = {"entropy": 50}
 auth.param.block_previous_password_num = 3
 auth.define_tables()
+startup.mark("auth")
 
 # #######################################################
 # Configure email sender for auth
 # #######################################################
 if settings.SMTP_SERVER:
+    from py4web.utils.mailer import Mailer
+
     auth.sender = Mailer(
         server=settings.SMTP_SERVER,
         sender=settings.SMTP_SENDER,
@@ -157,6 +167,7 @@ if settings.OAUTH2OKTA_CLIENT_ID:
 # files uploaded and reference by Field(type='upload')
 # #######################################################
 if settings.UPLOAD_FOLDER:
+    from py4web.utils.downloader import downloader
 
     @action("download/<filename>")
     @action.uses(db)
@@ -176,7 +187,7 @@ if settings.USE_CELERY:
     from celery import Celery
 
     # to use "from .common import scheduler" and then use it according
-    # to celery docs, examples in tasks.py
+    # to celery docs (tasks.py uses the broker-less queue of jobs.py)
     scheduler = Celery(
         "apps.%s.tasks" % settings.APP_NAME, broker=settings.CELERY_BROKER
     )
@@ -192,3 +203,4 @@ auth.enable(uses=(session, T, db), env=dict(T=T))
 # #######################################################
 unauthenticated = ActionFactory(db, session, T, flash, auth)
 authenticated = ActionFactory(db, session, T, flash, auth.user)
+startup.mark("auth plugins")
@@ -1,23 +1,120 @@
 import csv
+import datetime
+import hashlib
+import io
+import os
+import uuid
 from functools import reduce
 
-from yatl.helpers import TAG
+from yatl.helpers import TAG, INPUT, SPAN
+from pydal.validators import IS_DECIMAL_IN_RANGE
 
-from py4web import action, URL, request
-from py4web.utils.form import FormStyleBulma, FormStyleFactory
-from py4web.utils.grid import Grid, get_parent, GridClassStyleBulma
+from py4web import action, URL, request, abort
+from py4web.core import Fixture
+from py4web.utils.form import FormStyleBulma
+from py4web.utils.grid import get_parent, GridClassStyleBulma
 from .common import (
     db,
     session,
     auth,
+    settings,
+)
+from .htmx import (
+    NewHtmxAutocompleteWidget,
+    autocomplete_offset,
+    autocomplete_rows,
+    more_results,
+)
+from .models import bulk_insert_order_lines
+from .search import get_index, words_of
+from .fragments import fragment_cache
+from .labels import label_fields
+from .paging import KeysetGrid
+from .aggregates import customer_order_totals, order_line_totals
+from .jobs import enqueue, handlers, queue_stats
+from . import tasks  # registers the job handlers
+from .instrumentation import instrument
+from .partials import Page
+from .database import retry_when_locked, run_with_retry
+from .references import autocomplete_formstyle
+from .versions import conditional_get
+from .export import (
+    FORMATS,
+    attachment,
+    export,
+    order_columns,
+    order_line_columns,
+    order_query,
+    order_line_query,
 )
-from .htmx import NewHtmxAutocompleteWidget
 
 BUTTON = TAG.button
 
 
+def children_versions(tablename, *names):
+    """
+    the data versions (see versions.py) of the tablename rows of the parent_id
+    parent listed by a grid, and names; None when the grid shows a form
+    """
+    parent_id = request.query.get("parent_id", "")
+    if request.query.get("mode", "select") != "select" or not parent_id.isdigit():
+        return None
+    return ["%s/%s" % (tablename, int(parent_id))] + list(names)
+
+
+def record_id(row, table):
+    """the id of the table record in the grid row, None in forms"""
+    try:
+        return row[table._id]
+    except KeyError:
+        return None
+
+
+def order_total_represent(value, row):
+    """the order total, with the id the order line edits swap it out of band"""
+    order_id = record_id(row, db.order)
+    return SPAN(value, _id="order-%s-total" % order_id) if order_id else value
+
+
+def line_price_represent(value, row):
+    line_id = record_id(row, db.order_line)
+    return SPAN(value, _id="order-line-%s-price" % line_id) if line_id else value
+
+
+def line_quantity_represent(value, row):
+    line_id = record_id(row, db.order_line)
+    return line_quantity_input(line_id, value) if line_id else value
+
+
+def line_quantity_input(line_id, value, error=None, oob=False):
+    """
+    the quantity of an order line editable in place, a change posts it and
+    swaps back the line price (and the totals out of band)
+    """
+    attrs = {
+        "_hx-post": URL("order_lines/quantity", line_id),
+        "_hx-trigger": "change",
+        "_hx-target": "#order-line-%s-price" % line_id,
+        "_hx-swap": "outerHTML",
+    }
+    if oob:
+        attrs["_hx-swap-oob"] = "true"
+    return INPUT(
+        _type="number",
+        _name="quantity",
+        _id="order-line-%s-quantity" % line_id,
+        _value=value,
+        _min=0,
+        _step="any",
+        _class="input is-small is-danger" if error else "input is-small",
+        _title=error,
+        **attrs,
+    )
+
+
 @action("index")
 @action.uses(
+    instrument,
     "index.html",
     session,
     db,
@@ -29,14 +126,36 @@ def index():
 
 @action("customers")
 @action.uses(
-    "customers.html",
+    instrument,
+    Page("customers.html"),
     session,
     db,
     auth,
 )
 def customers():
-    grid = Grid(
+    #  order count and revenue come from the customer_summary row of each
+    #  customer, sortable and searchable without aggregating the orders
+    summary = db.customer_summary
+    grid = KeysetGrid(
+        keys=[db.customer.name, db.customer.id],
+        fields=[
+            db.customer.name,
+            db.customer.city,
+            db.customer.state,
+            summary.order_count,
+            summary.lifetime_total,
+        ],
+        headings=["NAME", "CITY", "STATE", "ORDERS", "REVENUE"],
         query=reduce(lambda a, b: (a & b), [db.customer.id > 0]),
+        left=summary.on(summary.customer == db.customer.id),
+        search_queries=[
+            ["Name", lambda value: db.customer.name.contains(value)],
+            [
+                "Revenue at least",
+                lambda value: summary.lifetime_total >= value,
+                IS_DECIMAL_IN_RANGE(0),
+            ],
+        ],
         orderby=[db.customer.name],
         details=False,
         grid_class_style=GridClassStyleBulma,
@@ -51,24 +170,26 @@ def customers():
 
 @action("customer_orders")
 @action.uses(
+    instrument,
     "customer_orders.html",
     session,
     db,
     auth,
 )
+@conditional_get(lambda: children_versions("order"))
 def customer_orders():
     #  set the default
     customer_id = get_parent(parent_field=db.order.customer)
     db.order.customer.default = customer_id
 
-    #  get order total
-    total = (
-        db(db.order.customer == customer_id)
-        .select(db.order.total.sum())
-        .first()[db.order.total.sum()]
-    )
+    #  get order count and total
+    count, total = customer_order_totals(customer_id)
+
+    db.order.total.represent = order_total_represent
 
-    grid = Grid(
+    grid = KeysetGrid(
+        keys=[db.order.id],
+        count=lambda: count,
         fields=[db.order.id, db.order.total],
         show_id=True,
         headings=["ORDER #", "TOTAL"],
@@ -80,7 +201,7 @@ def customer_orders():
         auto_process=False,
         rows_per_page=5,
         grid_class_style=GridClassStyleBulma,
-        formstyle=FormStyleBulma,
+        formstyle=autocomplete_formstyle(db.order),
         create=True,
         details=True,
         editable=True,
@@ -94,13 +215,15 @@ def customer_orders():
 
 @action("products")
 @action.uses(
-    "grid.html",
+    instrument,
+    Page("grid.html"),
     session,
     db,
     auth,
 )
 def products():
-    grid = Grid(
+    grid = KeysetGrid(
+        keys=[db.product.name, db.product.id],
         query=reduce(lambda a, b: (a & b), [db.product.id > 0]),
         orderby=[db.product.name],
         details=False,
@@ -113,11 +236,13 @@ def products():
 
 @action("order_lines")
 @action.uses(
+    instrument,
     "order_lines.html",
     session,
     db,
     auth,
 )
+@conditional_get(lambda: children_versions("order_line", "product"))
 def order_lines():
     #  set the default
     order_id = get_parent(parent_field=db.order_line.order)
@@ -125,25 +250,25 @@ def order_lines():
 
     left = db.product.on(db.order_line.product == db.product.id)
 
-    #  get order total
-    total = (
-        db(db.order_line.order == order_id)
-        .select(db.order_line.price.sum())
-        .first()[db.order_line.price.sum()]
-    )
+    #  get line count and order total
+    count, total = order_line_totals(order_id)
 
     if request.query.get("id"):
         db.order_line.price.readable = False
     db.order_line.price.writable = False
+    db.order_line.price.represent = line_price_represent
+    db.order_line.quantity.represent = line_quantity_represent
 
-    formstyle = FormStyleFactory()
-    formstyle.classes = FormStyleBulma.classes
-    formstyle.class_inner_exceptions = FormStyleBulma.class_inner_exceptions
-    formstyle.widgets["product"] = NewHtmxAutocompleteWidget(
-        url=URL("product_autocomplete"), order_id=order_id
+    formstyle = autocomplete_formstyle(
+        db.order_line,
+        product=NewHtmxAutocompleteWidget(
+            url=URL("product_autocomplete"), order_id=order_id
+        ),
     )
 
-    grid = Grid(
+    grid = KeysetGrid(
+        keys=[db.order_line.id],
+        count=lambda: count,
         fields=[
             db.product.name,
             db.order_line.quantity,
@@ -174,12 +299,45 @@ def order_lines():
 
     grid.process()
 
-    return dict(grid=grid, total=total)
+    return dict(grid=grid, total=total, order_id=order_id)
+
+
+@action("order_lines/quantity/<line_id:int>", method=["POST"])
+@action.uses(instrument, "htmx/order_line_quantity.html", session, db, auth)
+@retry_when_locked(db)
+def order_line_quantity(line_id):
+    """
+    change the quantity of one order line, returns its price and, out of
+    band, the new total of its order for the order lines and orders grids:
+    the total kept by the order_line hooks is read back, nothing is summed
+    """
+    line = db.order_line(line_id)
+    if not line:
+        abort(404)
+    quantity, error = db.order_line.quantity.validate(request.forms.get("quantity"))
+    if not error and quantity is None:
+        error = "Enter a quantity"
+    if not error:
+        #  the pricing hook needs the product along with the quantity
+        line.update_record(quantity=quantity, product=line.product)
+        line = db.order_line(line_id)
+    order = db.order(line.order)
+    return dict(
+        line=line,
+        order=order,
+        quantity=line_quantity_input(
+            line.id,
+            request.forms.get("quantity") if error else line.quantity,
+            error,
+            oob=True,
+        ),
+    )
 
 
 @action("orders")
 @action.uses(
-    "orders.html",
+    instrument,
+    Page("orders.html"),
     session,
     db,
     auth,
@@ -193,8 +351,10 @@ def orders():
         show_id = False
 
     db.order.total.writable = False
+    db.order.total.represent = order_total_represent
 
-    grid = Grid(
+    grid = KeysetGrid(
+        keys=[db.order.id],
         fields=[db.order.id, db.customer.name, db.order.total],
         show_id=show_id,
         headings=["ORDER #", "CUSTOMER", "TOTAL"],
@@ -203,7 +363,7 @@ def orders():
         left=left,
         grid_class_style=GridClassStyleBulma,
         details=False,
-        formstyle=FormStyleBulma,
+        formstyle=autocomplete_formstyle(db.order),
     )
 
     parent_id = None
@@ -213,18 +373,116 @@ def orders():
     return dict(grid=grid, parent_id=parent_id)
 
 
-def build_beers():
-    with open("/home/jim/Documents/beers.csv", "r") as f:
-        for x, line in enumerate(csv.reader(f)):
-            if x > 0:
-                beer = line[0]
-                price = line[1]
+def export_filters():
+    """the format and filters of an export request, 400 when malformed"""
+    format = request.query.get("format", "csv")
+    if format not in FORMATS:
+        abort(400, "format must be one of %s" % ", ".join(FORMATS))
+    try:
+        filters = dict(
+            customer_id=int(request.query.get("customer") or 0) or None,
+            since=request.query.get("since") or None,
+            until=request.query.get("until") or None,
+        )
+        for name in ("since", "until"):
+            if filters[name]:
+                filters[name] = datetime.date.fromisoformat(filters[name])
+    except ValueError:
+        abort(400, "customer must be an id, since and until YYYY-MM-DD dates")
+    return format, filters
+
+
+@action("export/orders")
+@action.uses(instrument, session, db, auth)
+def export_orders():
+    """
+    the orders with their customer name as csv or json (format=), filtered
+    by customer= id and by creation date from since= to until= (YYYY-MM-DD)
+    """
+    format, filters = export_filters()
+    left = db.customer.on(db.order.customer == db.customer.id)
+    attachment("orders", format)
+    return export(order_columns(), order_query(**filters), left, format)
+
+
+@action("export/order_lines")
+@action.uses(instrument, session, db, auth)
+def export_order_lines():
+    """
+    the order lines with their product name and unit price as csv or json,
+    filtered by order= id or by the export_orders filters of their order
+    """
+    format, filters = export_filters()
+    try:
+        order_id = int(request.query.get("order") or 0) or None
+    except ValueError:
+        abort(400, "order must be an id")
+    left = db.product.on(db.order_line.product == db.product.id)
+    attachment("order_lines", format)
+    return export(
+        order_line_columns(), order_line_query(order_id, **filters), left, format
+    )
+
 
-                print(beer, price)
+class JsonObjectBody(Fixture):
+    """
+    400 for the JSON requests whose body is not an object, before the
+    session fixture (which reads it as one) fails on it with a 500
+    """
+
+    def on_request(self, context):
+        if request.json is not None and not isinstance(request.json, dict):
+            abort(400, "the JSON body must be an object")
+
+
+json_object_body = JsonObjectBody()
+
+
+@action("bulk_order_lines", method=["POST"])
+@action.uses(instrument, json_object_body, session, db, auth)
+def bulk_order_lines():
+    """
+    add many lines to the order_id order in one request, posted either as
+    JSON ({"lines": [{"product": id, "quantity": qty}, ...]}) or as CSV with
+    a product,quantity header (an uploaded "file" or the request body)
+    """
+    order_id = request.params.get("order_id")
+    if not order_id or not db.order(order_id):
+        abort(400, "missing or invalid order_id")
+
+    if request.json is not None:
+        body = request.json
+        lines = body.get("lines", []) if isinstance(body, dict) else None
+        if not isinstance(lines, list) or not all(
+            isinstance(line, dict) for line in lines
+        ):
+            abort(400, 'expected {"lines": [{"product": id, "quantity": qty}, ...]}')
+    else:
+        upload = request.files.get("file")
+        if upload:
+            text = io.TextIOWrapper(upload.file, encoding="utf8")
+        else:
+            text = io.TextIOWrapper(request.body, encoding="utf8")
+        lines = csv.DictReader(text)
+
+    try:
+        #  read the lines once, the insert may run again if the db is locked
+        lines = list(lines)
+        ids = run_with_retry(db, bulk_insert_order_lines, lines, order_id=order_id)
+    except (KeyError, TypeError, ValueError, ArithmeticError) as e:
+        abort(400, "invalid order lines: %s" % e)
 
-                db.product.insert(name=beer, price=price)
+    return dict(
+        order_id=int(order_id), inserted=len(ids), total=db.order(order_id).total
+    )
 
-    db.commit()
+
+def product_autocomplete_versions():
+    """the data versions of the products offered to the order_id order"""
+    order_id = request.params.get("order_id", "")
+    if not order_id.isdigit():
+        return None
+    return ["product", "order_line/%s" % int(order_id)]
 
 
 @action(
@@ -232,17 +490,61 @@ def build_beers():
     method=["GET", "POST"],
 )
 @action.uses(
+    instrument,
     "htmx/autocomplete.html",
     session,
     db,
 )
+@conditional_get(product_autocomplete_versions)
 def product_autocomplete():
     tablename = request.params.tablename
     fieldname = request.params.fieldname
     order_id = request.params.order_id
+    search = request.params.get("order_line_product_search", "")
+
+    #  the results are the same for every order with the same products on it
+    products_already_on_order = sorted(
+        row.product
+        for row in db(db.order_line.order == order_id).select(db.order_line.product)
+    )
+    excluded = hashlib.sha1(repr(products_already_on_order).encode()).hexdigest()
+
+    return fragment_cache.get(
+        "htmx/autocomplete.html",
+        (
+            "product_autocomplete",
+            tablename,
+            fieldname,
+            search,
+            excluded,
+            autocomplete_offset(),
+        ),
+        lambda: product_autocomplete_data(
+            tablename, fieldname, search, order_id, products_already_on_order
+        ),
+        depends=["product"],
+    )
+
+
+def products_not_on_order(order_id, products_already_on_order):
+    """
+    the query (and left join) excluding the products already on the order,
+    as set by settings.PRODUCT_EXCLUSION
+    """
+    if settings.PRODUCT_EXCLUSION == "anti_join":
+        left = db.order_line.on(
+            (db.order_line.product == db.product.id) & (db.order_line.order == order_id)
+        )
+        return db.order_line.id == None, left
+    return ~db.product.id.belongs(products_already_on_order), None
 
+
+def product_autocomplete_data(
+    tablename, fieldname, search, order_id, products_already_on_order
+):
     field = db[tablename][fieldname]
     data = []
+    next_offset = None
 
     fk_table = None
 
@@ -250,17 +552,26 @@ def product_autocomplete():
         fk_table = field.requires.ktable
         fk_field = field.requires.kfield
 
-        queries = []
-        products_already_on_order = db(db.order_line.order == order_id)._select(
-            db.order_line.product
-        )
-        queries.append(~db.product.id.belongs(products_already_on_order))
-        queries.append(
-            db.product.name.contains(request.params["order_line_product_search"])
-        )
-        query = reduce(lambda a, b: (a & b), queries)
-
-        data = db(query).select(orderby=field.requires.orderby)
+        fields = label_fields(db.product, field.requires.label)
+        index = get_index("product", ["name"])
+        if index and words_of(search):
+            data, next_offset = autocomplete_rows(
+                db.product, fields, search, index, exclude=products_already_on_order
+            )
+        else:
+            exclusion, left = products_not_on_order(order_id, products_already_on_order)
+            queries = []
+            queries.append(exclusion)
+            queries.append(db.product.name.contains(search))
+            query = reduce(lambda a, b: (a & b), queries)
+
+            data, next_offset = autocomplete_rows(
+                db.product,
+                fields,
+                query=query,
+                orderby=field.requires.orderby,
+                left=left,
+            )
 
     return dict(
         data=data,
@@ -268,4 +579,83 @@ def product_autocomplete():
         fieldname=fieldname,
         fk_table=fk_table,
         data_label=field.requires.label,
+        offset=autocomplete_offset(),
+        more=more_results(
+            URL("product_autocomplete"), tablename, fieldname, next_offset
+        ),
     )
+
+
+@action("stats/fragment_cache")
+@action.uses(session, db, auth.user)
+def fragment_cache_stats():
+    return fragment_cache.stats()
+
+
+@action("jobs")
+@action.uses(
+    instrument,
+    "jobs.html",
+    session,
+    db,
+    auth.user,
+)
+def jobs():
+    rows = db(db.job.id > 0).select(orderby=~db.job.id, limitby=(0, 20))
+    return dict(jobs=rows, stats=queue_stats())
+
+
+@action("jobs/enqueue", method=["POST"])
+@action.uses(instrument, "htmx/job.html", session, db, auth.user)
+def enqueue_job():
+    """queue a job, returns its status fragment which polls until it is over"""
+    name = request.params.get("name")
+    if name not in handlers:
+        abort(400, "unknown job %r" % name)
+
+    args = {}
+    if name == "import-products":
+        upload = request.files.get("file")
+        if not upload:
+            abort(400, "missing file")
+        path = os.path.join(settings.UPLOAD_FOLDER, "import-%s.csv" % uuid.uuid4().hex)
+        upload.save(path)
+        args["path"] = path
+    elif name == "rebuild-totals":
+        args["verify_only"] = bool(request.params.get("verify_only"))
+
+    return dict(job=db.job(run_with_retry(db, enqueue, name, **args)))
+
+
+@action("jobs/status/<job_id:int>")
+@action.uses("htmx/job.html", session, db, auth.user)
+def job_status(job_id):
+    job = db.job(job_id)
+    if not job:
+        abort(404)
+    return dict(job=job)
+
+
+@action("jobs/metrics")
+@action.uses("htmx/job_metrics.html", session, db, auth.user)
+def job_metrics():
+    return dict(stats=queue_stats())
+
+
+@action("stats/jobs")
+@action.uses(session, db, auth.user)
+def job_stats():
+    return queue_stats()
+
+
+@action("queries")
+@action.uses("queries.html", session, db, auth.user)
+def queries():
+    return dict(requests=instrument.stats())
+
+
+@action("stats/queries")
+@action.uses("htmx/query_panel.html", session, db, auth.user)
+def query_stats():
+    """the statements, timings and N+1 warnings of the last requests"""
+    return dict(requests=instrument.stats())
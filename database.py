@@ -0,0 +1,117 @@
+"""
+SQLite performance profile
+
+With the default rollback journal, a reader holding the database keeps the
+writer from committing, and an order_line write (which also updates its
+order, its customer summary, ...) holds the lock for all of its statements.
+Under a few concurrent requests that ends in "database is locked". So:
+
+- DB_SQLITE_PRAGMAS are applied to every new connection (WAL journal, so
+  readers and the writer no longer block each other, relaxed fsync, bigger
+  page cache, memory mapped reads, busy timeout)
+- connections are kept in a pool of DB_POOL_SIZE and reused by the request
+  threads, pydal does not pool SQLite connections otherwise and every
+  request would open one and lose its page cache. That is safe because
+  pydal opens them with check_same_thread=False (the pool is skipped when
+  driver_args turn it back on), a connection only goes back to the pool
+  once its transaction was committed or rolled back, and the pragmas are
+  settings of the connection: set once by the after_connection hook when it
+  is opened, they stay in effect every time it is reused
+- write transactions run through run_with_retry(), which rolls back and
+  runs them again when SQLite still reports the database locked after the
+  busy timeout, up to DB_BUSY_RETRIES times
+
+Stress it with
+
+    python -m apps.htmx_demo.benchmarks.sqlite_stress
+"""
+
+import functools
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from pydal._globals import THREAD_LOCAL
+
+from . import settings
+
+#  seconds before the first retry of a locked transaction, doubled each time
+RETRY_DELAY = 0.05
+
+
+def configure_connection(adapter):
+    """pydal after_connection hook applying DB_SQLITE_PRAGMAS"""
+    if adapter.dbengine != "sqlite":
+        return
+    for name, value in settings.DB_SQLITE_PRAGMAS.items():
+        adapter.execute("PRAGMA %s=%s;" % (name, value))
+
+
+def use_connection_pool(db, size):
+    """
+    keep up to size connections of db open for reuse, sqlite included when
+    its connections can be used by any thread
+    """
+    adapter = db._adapter
+    if adapter.dbengine == "sqlite" and adapter.driver_args.get("check_same_thread"):
+        return
+    adapter.pool_size = size
+
+
+@contextmanager
+def connection(db):
+    """
+    run the block with the connection of this thread, or with one taken from
+    the pool and given back at its end when the thread holds none, e.g. in a
+    template rendered after the db fixture gave the request's one back
+    """
+    adapter = db._adapter
+    if getattr(THREAD_LOCAL, adapter._connection_uname_, None) is not None:
+        yield
+        return
+    db.get_connection_from_pool_or_new()
+    try:
+        yield
+    finally:
+        db.recycle_connection_in_pool_or_close("rollback")
+
+
+def is_locked(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in message or "busy" in message
+    )
+
+
+def run_with_retry(db, func, *args, **kwargs):
+    """
+    call func and commit, rolling back and calling it again when the
+    database is locked; returns what func returns
+    """
+    attempt = 0
+    while True:
+        try:
+            result = func(*args, **kwargs)
+            db.commit()
+            return result
+        except sqlite3.OperationalError as error:
+            if not is_locked(error) or attempt >= settings.DB_BUSY_RETRIES:
+                raise
+            db.rollback()
+            #  jitter, so the transactions that collided do not collide again
+            time.sleep(RETRY_DELAY * 2**attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+def retry_when_locked(db):
+    """decorator running the function through run_with_retry"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_with_retry(db, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
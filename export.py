@@ -0,0 +1,154 @@
+"""
+Streaming csv and json exports of the orders and order lines
+
+The grids page through the rows a few at a time, the exports write them all.
+They read EXPORT_CHUNK_SIZE rows per query, seeking from the last id read
+(WHERE id > last ORDER BY id LIMIT n, as cheap for the last chunk as for the
+first), as plain tuples without building pydal Rows, and send every chunk
+before reading the next one: memory stays the same for a thousand or for a
+million rows.
+
+The actions return the generator, py4web iterates it once the action and its
+fixtures are done and the db fixture has already given the request's
+connection back, so the generator takes one of its own and returns it when
+done (or when the client goes away).
+
+Benchmark it with
+
+    python -m apps.htmx_demo.benchmarks.export
+"""
+
+import csv
+import datetime
+import io
+import json
+
+from py4web import response
+
+from .common import db, settings
+
+FORMATS = {"csv": "text/csv", "json": "application/json"}
+
+
+def order_columns():
+    """(heading, field) of the orders export, the id first"""
+    return [
+        ("order", db.order.id),
+        ("created_on", db.order.created_on),
+        ("customer_id", db.order.customer),
+        ("customer", db.customer.name),
+        ("total", db.order.total),
+    ]
+
+
+def order_line_columns():
+    """(heading, field) of the order lines export, the id first"""
+    return [
+        ("line", db.order_line.id),
+        ("order", db.order_line.order),
+        ("product_id", db.order_line.product),
+        ("product", db.product.name),
+        ("unit_price", db.product.price),
+        ("quantity", db.order_line.quantity),
+        ("price", db.order_line.price),
+    ]
+
+
+def order_query(customer_id=None, since=None, until=None):
+    """the orders of customer_id created from the since to the until date"""
+    query = db.order.id > 0
+    if customer_id:
+        query &= db.order.customer == customer_id
+    if since:
+        query &= db.order.created_on >= since
+    if until:
+        query &= db.order.created_on < until + datetime.timedelta(days=1)
+    return query
+
+
+def order_line_query(order_id=None, customer_id=None, since=None, until=None):
+    """the lines of order_id, or of the orders order_query() selects"""
+    query = db.order_line.id > 0
+    if order_id:
+        query &= db.order_line.order == order_id
+    if customer_id or since or until:
+        orders = db(order_query(customer_id, since, until))._select(db.order.id)
+        query &= db.order_line.order.belongs(orders)
+    return query
+
+
+def formatter(field):
+    """the function turning the raw values of field into csv/json values"""
+    if field.type.startswith("decimal"):
+        template = "%%.%sf" % field.type.rstrip(")").split(",")[-1].strip()
+        return lambda value: None if value is None else template % value
+    if field.type in ("date", "datetime", "time"):
+        return lambda value: value if value is None else str(value)
+    return lambda value: value
+
+
+def chunks(query, fields, left=None, size=None):
+    """
+    lists of at most size tuples of the fields (the first one the id) of the
+    rows matching query, in id order
+    """
+    size = size or settings.EXPORT_CHUNK_SIZE
+    key = fields[0]
+    formats = [formatter(field) for field in fields]
+    last = None
+    while True:
+        seek = query if last is None else query & (key > last)
+        sql = db(seek)._select(*fields, left=left, orderby=key, limitby=(0, size))
+        rows = db.executesql(sql)
+        if not rows:
+            return
+        yield [tuple(f(value) for f, value in zip(formats, row)) for row in rows]
+        if len(rows) < size:
+            return
+        last = rows[-1][0]
+
+
+def csv_stream(headings, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headings)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def json_stream(headings, chunks):
+    yield "["
+    separator = "\n"
+    for rows in chunks:
+        yield separator + ",\n".join(
+            json.dumps(dict(zip(headings, row))) for row in rows
+        )
+        separator = ",\n"
+    yield "\n]\n"
+
+
+STREAMS = {"csv": csv_stream, "json": json_stream}
+
+
+def attachment(name, format):
+    """set the headers downloading the response as name.csv or name.json"""
+    response.headers["Content-Type"] = FORMATS[format] + "; charset=utf-8"
+    response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (
+        name,
+        format,
+    )
+
+
+def export(columns, query, left=None, format="csv"):
+    """generator of the csv or json export of the columns of the query rows"""
+    headings = [heading for heading, field in columns]
+    fields = [field for heading, field in columns]
+    db.get_connection_from_pool_or_new()
+    try:
+        yield from STREAMS[format](headings, chunks(query, fields, left))
+    finally:
+        db.recycle_connection_in_pool_or_close("rollback")
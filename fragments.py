@@ -0,0 +1,100 @@
+"""
+Cache of rendered htmx fragments
+
+Fragments are stored in common.cache under a key made of the request values
+they depend on plus the write generation of the tables they read; a write to
+one of those tables bumps its generation once it commits (see
+transactions.py), so older entries are never hit again and age out of the
+LRU; the transaction doing the write renders those fragments without the
+cache. Generations are per process, writes done by other processes are
+picked up when the entries expire (FRAGMENT_CACHE_TTL).
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+
+from py4web import render, request, URL
+
+from .common import cache, settings
+from .instrumentation import instrument
+from .transactions import on_commit, pending, uncommitted
+
+_lock = threading.Lock()
+generations = defaultdict(int)
+
+
+def bump(*tablenames):
+    """bump the generations of tablenames when the current transaction commits"""
+    pending("fragments").update(tablenames)
+
+
+@on_commit("fragments")
+def bump_committed(tablenames):
+    with _lock:
+        for tablename in tablenames:
+            generations[tablename] += 1
+
+
+def written(*tablenames):
+    """True when the uncommitted transaction of this thread wrote to tablenames"""
+    return not uncommitted("fragments").isdisjoint(tablenames)
+
+
+def track_writes(table):
+    """bump the generation of table on every insert, update and delete"""
+    tablename = table._tablename
+    table._after_insert.append(lambda f, i: bump(tablename))
+    table._after_update.append(lambda s, f: bump(tablename))
+    table._after_delete.append(lambda s: bump(tablename))
+
+
+def render_template(template, output):
+    path = os.path.join(settings.APP_FOLDER, "templates")
+    context = dict(request=request, URL=URL)
+    context.update(output)
+    start = time.perf_counter()
+    html = render(filename=template, path=path, context=context)
+    instrument.record_template(time.perf_counter() - start)
+    return html
+
+
+class FragmentCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template, key, callback, depends=()):
+        """
+        the template rendered with the dict returned by callback, from the
+        cache when the same key was rendered since the last write to depends
+        """
+        if not settings.FRAGMENT_CACHE_TTL or written(*depends):
+            return render_template(template, callback())
+
+        key = (template, key, tuple(generations[name] for name in depends))
+        missed = []
+
+        def render_fragment():
+            missed.append(True)
+            return render_template(template, callback())
+
+        html = cache.get(key, render_fragment, settings.FRAGMENT_CACHE_TTL)
+        with _lock:
+            if missed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return html
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=round(self.hits / requests, 3) if requests else None,
+        )
+
+
+fragment_cache = FragmentCache()
@@ -2,91 +2,125 @@ import base64
 import codecs
 import json
 import pickle
-from functools import reduce
+import re
+from functools import lru_cache, reduce
+
+from yatl import DIV, INPUT
+from yatl.sanitizer import xmlescape
+
+from .common import session, db, auth, settings
+from .search import get_index, select_ranked, words_of
+from .fragments import fragment_cache
+from .labels import label_fields, label_resolver
+from .instrumentation import instrument
+from .versions import conditional_get, tracked
+from py4web import action, request, URL
 
-from yatl import DIV, INPUT, SCRIPT
+#  markers of the per render values in the compiled widget markup
+VALUE_MARK = "__autocomplete_value__"
+LABEL_MARK = "__autocomplete_label__"
 
-from .common import session, db, auth
-from py4web import action, request, URL
 
+class AutocompleteControl:
+    """the markup of an autocomplete widget, value and label filled in at render"""
 
-def autocomplete_widget(field, values_dict):
-    control = DIV()
-    if "_table" in dir(field):
-        tablename = field._table
-    else:
-        tablename = "no_table"
+    name = "div"
 
-    value = values_dict[field.name] if field.name in values_dict else ""
+    def __init__(self, parts, value, label):
+        self.parts = parts
+        self.value = value
+        self.label = label
+
+    def xml(self):
+        before, between, after = self.parts
+        value = "" if self.value is None else xmlescape(str(self.value))
+        #  a LazyLabel, resolved (and escaped) only now
+        label = "" if self.label is None else str(self.label)
+        return before + value + between + label + after
+
+    __str__ = xml
+
+
+@lru_cache(maxsize=256)
+def compile_autocomplete(tablename, fieldname, url, vals, title, placeholder):
+    """
+    the markup of the autocomplete widget of tablename.fieldname, built once
+    and split around the value and label that change at every render
+    """
+    prefix = "%s_%s" % (tablename, fieldname)
     #  build the div-hidden input field to hold the value
     hidden_input = INPUT(
         _type="text",
-        _id="%s_%s" % (tablename, field.name),
-        _name=field.name,
-        _value=value,
+        _id=prefix,
+        _name=fieldname,
+        _value=VALUE_MARK,
     )
-    hidden_div = DIV(hidden_input, _style="display: none;")
-    control.append(hidden_div)
-
-    #  build the input field to accept the text
-
-    #  set the htmx attributes
+    #  set the htmx attributes, hx-vals is on the control so that the
+    #  "more..." option of the results inherits it too; arrow down moves to
+    #  the results, see the delegated handler in static/js/utils.js
     attrs = {
-        "_hx-post": URL("htmx/autocomplete"),
+        "_hx-get": url,
         "_hx-trigger": "keyup changed delay:500ms",
-        "_hx-target": "#%s_%s_autocomplete_results" % (tablename, field.name),
+        "_hx-target": "#%s_autocomplete_results" % prefix,
         "_hx-indicator": ".htmx-indicator",
-        "_hx-vals": '{"tablename": "%(tablename)s", "fieldname": "%(fieldname)s"}'
-        % {"tablename": str(tablename), "fieldname": field.name},
+        "_data-autocomplete": "#%s_autocomplete" % prefix,
     }
-    search_value = None
-    if value and field.requires:
-        row = (
-            db(db[field.requires.ktable][field.requires.kfield] == value)
-            .select()
-            .first()
-        )
-        if row:
-            search_value = field.requires.label % row
-
-    control.append(
+    control = DIV(
+        DIV(hidden_input, _style="display: none;"),
         INPUT(
             _type="text",
-            _id="%s_%s_search" % (tablename, field.name),
-            _name="%s_%s_search" % (tablename, field.name),
-            _value=search_value,
+            _id="%s_search" % prefix,
+            _name="%s_search" % prefix,
+            _value=LABEL_MARK,
             _class="input",
-            _placeholder="..",
-            _title="Enter search string",
+            _placeholder=placeholder,
+            _title=title,
             _autocomplete="off",
             **attrs,
-        )
+        ),
+        DIV(_id="%s_autocomplete_results" % prefix),
+        **{"_hx-vals": vals},
     )
+    before, rest = control.xml().split(VALUE_MARK)
+    between, after = rest.split(LABEL_MARK)
+    return before, between, after
 
-    control.append(DIV(_id="%s_%s_autocomplete_results" % (tablename, field.name)))
-
-    control.append(
-        SCRIPT(
-            """
-    htmx.onLoad(function(elt) {
-        document.querySelector('#%(table)s_%(field)s_search').onkeydown = check_%(table)s_%(field)s_down_key;
-        \n
-        function check_%(table)s_%(field)s_down_key(e) {
-            if (e.keyCode == '40') {
-                document.querySelector('#%(table)s_%(field)s_autocomplete').focus();
-                document.querySelector('#%(table)s_%(field)s_autocomplete').selectedIndex = 0;
-            }
-        }
-    })
-        """
-            % {
-                "table": tablename,
-                "field": field.name,
-            }
-        )
+
+def autocomplete_control(field, value, url, values, title, placeholder):
+    tablename = field._table if "_table" in dir(field) else "no_table"
+    label = None
+    if value and field.requires:
+        label = label_resolver().register(field.requires, value)
+    parts = compile_autocomplete(
+        str(tablename),
+        field.name,
+        str(url),
+        json.dumps(dict(tablename=str(tablename), fieldname=field.name, **values)),
+        None if title is None else str(title),
+        str(placeholder),
     )
+    return AutocompleteControl(parts, value, label)
+
 
-    return control
+def autocomplete_widget(field, values_dict):
+    value = values_dict[field.name] if field.name in values_dict else ""
+    return autocomplete_control(
+        field, value, URL("htmx/autocomplete"), {}, "Enter search string", ".."
+    )
+
+
+def autocomplete_versions():
+    """the data version of the table the autocomplete searches, when tracked"""
+    tablename = request.params.tablename
+    fieldname = request.params.fieldname
+    if tablename not in db.tables or fieldname not in db[tablename].fields:
+        return None
+    requires = db[tablename][fieldname].requires
+    ktable = getattr(requires, "ktable", None)
+    #  an extra query may read other tables
+    if ktable and tracked(ktable) and not request.params.query:
+        return [ktable]
+    return None
 
 
 @action(
@@ -94,17 +128,38 @@ def autocomplete_widget(field, values_dict):
     method=["GET", "POST"],
 )
 @action.uses(
+    instrument,
     session,
     db,
     "htmx/autocomplete.html",
 )
+@conditional_get(autocomplete_versions)
 def autocomplete():
     tablename = request.params.tablename
     fieldname = request.params.fieldname
     autocomplete_query = request.params.query
+    search = request.params.get(f"{tablename}_{fieldname}_search", "")
+
+    requires = db[tablename][fieldname].requires
+    return fragment_cache.get(
+        "htmx/autocomplete.html",
+        (
+            "htmx/autocomplete",
+            tablename,
+            fieldname,
+            search,
+            autocomplete_query,
+            autocomplete_offset(),
+        ),
+        lambda: autocomplete_data(tablename, fieldname, autocomplete_query, search),
+        depends=[requires.ktable] if requires else [],
+    )
+
 
+def autocomplete_data(tablename, fieldname, autocomplete_query, search):
     field = db[tablename][fieldname]
     data = []
+    next_offset = None
 
     fk_table = None
 
@@ -112,33 +167,29 @@ def autocomplete():
         fk_table = field.requires.ktable
         fk_field = field.requires.kfield
 
-        queries = []
         if "_autocomplete_search_fields" in dir(field):
-            for sf in field._autocomplete_search_fields:
-                queries.append(
-                    db[fk_table][sf].contains(
-                        request.params[f"{tablename}_{fieldname}_search"]
-                    )
-                )
-            query = reduce(lambda a, b: (a | b), queries)
+            search_fields = field._autocomplete_search_fields
         else:
-            for f in db[fk_table]:
-                if f.type in ["string", "text"]:
-                    queries.append(
-                        db[fk_table][f.name].contains(
-                            request.params[f"{tablename}_{fieldname}_search"]
-                        )
-                    )
-
-            query = reduce(lambda a, b: (a | b), queries)
-
-        if len(queries) == 0:
-            queries = [db[fk_table].id > 0]
-            query = reduce(lambda a, b: (a & b), queries)
-
-        if autocomplete_query:
-            query = reduce(lambda a, b: (a & b), [autocomplete_query, query])
-        data = db(query).select(orderby=field.requires.orderby)
+            search_fields = [
+                f.name for f in db[fk_table] if f.type in ["string", "text"]
+            ]
+
+        fields = label_fields(db[fk_table], field.requires.label)
+        index = get_index(fk_table, search_fields)
+        if index and words_of(search) and not autocomplete_query:
+            data, next_offset = autocomplete_rows(db[fk_table], fields, search, index)
+        else:
+            queries = [db[fk_table][sf].contains(search) for sf in search_fields]
+            if queries:
+                query = reduce(lambda a, b: (a | b), queries)
+            else:
+                query = db[fk_table].id > 0
+
+            if autocomplete_query:
+                query = reduce(lambda a, b: (a & b), [autocomplete_query, query])
+            data, next_offset = autocomplete_rows(
+                db[fk_table], fields, query=query, orderby=field.requires.orderby
+            )
 
     return dict(
         data=data,
@@ -146,6 +197,56 @@ def autocomplete():
         fieldname=fieldname,
         fk_table=fk_table,
         data_label=field.requires.label,
+        offset=autocomplete_offset(),
+        more=more_results(URL("htmx/autocomplete"), tablename, fieldname, next_offset),
+    )
+
+
+def autocomplete_offset():
+    try:
+        return max(int(request.params.get("offset") or 0), 0)
+    except ValueError:
+        return 0
+
+
+def autocomplete_rows(
+    table,
+    fields,
+    search=None,
+    index=None,
+    query=None,
+    orderby=None,
+    exclude=(),
+    left=None,
+):
+    """
+    one page of at most AUTOCOMPLETE_LIMIT rows starting at the requested
+    offset, from the search index when given, else from query; returns the
+    rows and the offset of the next page (None if this is the last one)
+    """
+    offset = autocomplete_offset()
+    limit = settings.AUTOCOMPLETE_LIMIT
+    if index:
+        ids = index.search(search, limit=offset + limit + 1, exclude=exclude)
+        rows = select_ranked(table, ids[offset:], fields=fields)
+    else:
+        rows = db(query).select(
+            *fields, left=left, orderby=orderby, limitby=(offset, offset + limit + 1)
+        )
+    if len(rows) > limit:
+        return rows[:limit], offset + limit
+    return rows, None
+
+
+def more_results(url, tablename, fieldname, next_offset):
+    """the url and hx-vals requesting the next page of autocomplete results"""
+    if next_offset is None:
+        return None
+    #  the other values are inherited from the hx-vals of the widget
+    return dict(
+        url=url,
+        vals=json.dumps(dict(offset=next_offset)),
+        include="#%s_%s_search" % (tablename, fieldname),
     )
 
 
@@ -160,84 +261,7 @@ class NewHtmxAutocompleteWidget:
 
     def make(self, field, value, error, title, placeholder="", readonly=False):
         #  TODO: handle readonly parameter
-        control = DIV()
-        if "_table" in dir(field):
-            tablename = field._table
-        else:
-            tablename = "no_table"
-
-        #  build the div-hidden input field to hold the value
-        hidden_input = INPUT(
-            _type="text",
-            _id="%s_%s" % (tablename, field.name),
-            _name=field.name,
-            _value=value,
-        )
-        hidden_div = DIV(hidden_input, _style="display: none;")
-        control.append(hidden_div)
-
-        #  build the input field to accept the text
-
-        #  set the htmx attributes
-
-        values = {
-            "tablename": str(tablename),
-            "fieldname": field.name,
-            "query": str(self.query) if self.query else "",
-            **self.attrs,
-        }
-        attrs = {
-            "_hx-post": self.url,
-            "_hx-trigger": "keyup changed delay:500ms",
-            "_hx-target": "#%s_%s_autocomplete_results" % (tablename, field.name),
-            "_hx-indicator": ".htmx-indicator",
-            "_hx-vals": json.dumps(values),
-        }
-        search_value = None
-        if value and field.requires:
-            row = (
-                db(db[field.requires.ktable][field.requires.kfield] == value)
-                .select()
-                .first()
-            )
-            if row:
-                search_value = field.requires.label % row
-
-        control.append(
-            INPUT(
-                _type="text",
-                _id="%s_%s_search" % (tablename, field.name),
-                _name="%s_%s_search" % (tablename, field.name),
-                _value=search_value,
-                _class="input",
-                _placeholder=placeholder if placeholder and placeholder != "" else "..",
-                _title=title,
-                _autocomplete="off",
-                **attrs,
-            )
-        )
-
-        control.append(DIV(_id="%s_%s_autocomplete_results" % (tablename, field.name)))
-
-        control.append(
-            SCRIPT(
-                """
-        htmx.onLoad(function(elt) {
-            document.querySelector('#%(table)s_%(field)s_search').onkeydown = check_%(table)s_%(field)s_down_key;
-            \n
-            function check_%(table)s_%(field)s_down_key(e) {
-                if (e.keyCode == '40') {
-                    document.querySelector('#%(table)s_%(field)s_autocomplete').focus();
-                    document.querySelector('#%(table)s_%(field)s_autocomplete').selectedIndex = 0;
-                }
-            }
-        })
-            """
-                % {
-                    "table": tablename,
-                    "field": field.name,
-                }
-            )
+        values = {"query": str(self.query) if self.query else "", **self.attrs}
+        return autocomplete_control(
+            field, value, self.url, values, title, placeholder or ".."
         )
-
-        return control
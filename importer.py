@@ -0,0 +1,190 @@
+"""
+Streaming product catalog importer
+
+The csv file is read one row at a time (first row is the header, then
+name,price) and the rows are handled in batches. Products are matched by
+name: existing ones get their price updated, new ones are inserted with a
+single DB-API executemany per batch by insert_many() (bypassing the pydal
+per row overhead and the product insert hooks, so also its validators).
+Rows whose price the product.price validator refuses (out of its 0..9999
+range) are skipped and counted as rejected. The whole import runs in one
+transaction.
+
+    python -m apps.htmx_demo.commands import-products beers.csv
+"""
+
+import csv
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from .common import db, logger
+from . import search, fragments, versions
+from .repricing import batched_repricing
+
+
+def read_products(f):
+    """yield (line number, name, price) for every data row of the csv file f"""
+    reader = csv.reader(f)
+    next(reader, None)
+    for line_number, row in enumerate(reader, start=2):
+        if not row or not row[0].strip():
+            continue
+        try:
+            price = Decimal(row[1].strip().lstrip("$"))
+        except (IndexError, InvalidOperation):
+            raise ValueError("line %s: invalid price %r" % (line_number, row[1:2]))
+        yield line_number, row[0].strip(), price
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+
+def insert_many(table, items):
+    """insert the items (dicts with the same keys) with one DB-API executemany"""
+    placeholder = PLACEHOLDERS.get(getattr(db._adapter.driver, "paramstyle", None))
+    if not placeholder:
+        return table.bulk_insert(items)
+    fieldnames = list(items[0])
+    sql = "INSERT INTO %s(%s) VALUES (%s);" % (
+        table._rname,
+        ", ".join(table[name]._rname for name in fieldnames),
+        ", ".join([placeholder] * len(fieldnames)),
+    )
+    values = [tuple(str(item[name]) for name in fieldnames) for item in items]
+    db._adapter.cursor.executemany(sql, values)
+
+
+REJECTED_LINES = 10
+
+
+def price_error(price):
+    """the error of the product.price validators for price, None if valid"""
+    requires = db.product.price.requires
+    for validator in requires if isinstance(requires, (list, tuple)) else [requires]:
+        error = validator(price)[1]
+        if error:
+            return error
+    return None
+
+
+class ImportStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.rejected = 0
+        #  the line numbers of the first REJECTED_LINES rejected rows
+        self.rejected_lines = []
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0
+
+    def __str__(self):
+        return (
+            "%s rows (%s inserted, %s updated, %s unchanged, %s rejected) "
+            "in %.1fs, %d rows/s"
+            % (
+                self.rows,
+                self.inserted,
+                self.updated,
+                self.unchanged,
+                self.rejected,
+                self.seconds,
+                self.rows_per_second,
+            )
+        )
+
+
+def import_batches(f, batch_size, index, stats, progress):
+    """upsert the products of the csv file f batch by batch, counted in stats"""
+    for batch in batches(read_products(f), batch_size):
+        new_products = {}
+        for line_number, name, price in batch:
+            stats.rows += 1
+            error = price_error(price)
+            if error:
+                stats.rejected += 1
+                if len(stats.rejected_lines) < REJECTED_LINES:
+                    stats.rejected_lines.append(line_number)
+                    logger.warning("product import line %s: %s", line_number, error)
+                continue
+            if name in new_products:
+                new_products[name] = price
+            elif name in index:
+                product_id, current_price = index[name]
+                if current_price is not None and Decimal(str(current_price)) == price:
+                    stats.unchanged += 1
+                    continue
+                if product_id:
+                    db(db.product.id == product_id).update(price=price)
+                else:
+                    #  inserted by an earlier batch of this import
+                    db(db.product.name == name).update(price=price)
+                index[name] = (product_id, price)
+                stats.updated += 1
+            else:
+                new_products[name] = price
+
+        if new_products:
+            insert_many(
+                db.product,
+                [dict(name=name, price=price) for name, price in new_products.items()],
+            )
+            for name, price in new_products.items():
+                index[name] = (None, price)
+            stats.inserted += len(new_products)
+
+        if progress:
+            progress(stats)
+
+
+def import_products(f, batch_size=1000, progress=None):
+    """
+    import the products of the csv file f, upserting by name
+
+    progress is called with the ImportStats after every batch; on error the
+    transaction is rolled back and nothing is imported
+    """
+    stats = ImportStats()
+    #  name -> (id, price) of the products already in the catalog, read as raw
+    #  tuples since building a Row per product dominates on large catalogs
+    index = {
+        name: (product_id, price)
+        for product_id, name, price in db.executesql(
+            db(db.product.id > 0)._select(
+                db.product.id, db.product.name, db.product.price
+            )
+        )
+    }
+    try:
+        with batched_repricing(), versions.batched():
+            import_batches(f, batch_size, index, stats, progress)
+            #  for the new products too, inserted without the hooks
+            versions.bump("product")
+            fragments.bump("product")
+        db.commit()
+        #  new products skipped the hooks that maintain the search index
+        search.invalidate("product")
+    except Exception:
+        db.rollback()
+        raise
+
+    logger.info("product import: %s", stats)
+    return stats
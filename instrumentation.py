@@ -0,0 +1,150 @@
+"""
+Per request query instrumentation
+
+The instrument fixture records every SQL statement an action runs (with its
+duration), the time spent rendering its template and the total time, then
+
+- adds a Server-Timing header (db, tpl and app durations, shown by the
+  browser devtools next to the request)
+- logs one json line per request through common.logger
+- warns about N+1 patterns: the same statement shape (the SQL with its
+  literals replaced by ?) running QUERY_REPEAT_THRESHOLD times or more
+- warns about statements slower than SLOW_QUERY_MS
+
+and keeps the last requests for the stats/queries panel. List it first in
+action.uses so that it also sees the template being rendered:
+
+    @action.uses(instrument, "orders.html", session, db, auth)
+"""
+
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from py4web import request, response
+from py4web.core import Fixture, Template
+from pydal.helpers.classes import ExecutionHandler
+
+from .common import db, settings, logger
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def shape_of(sql):
+    """the statement with its literals replaced by ?"""
+    return LITERALS.sub("?", sql)
+
+
+class Instrumentation(Fixture):
+    def __init__(self, keep=100):
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=keep)
+
+    def on_request(self, context):
+        if not settings.INSTRUMENTATION:
+            return
+        self.local_initialize(self)
+        self.local.start = time.perf_counter()
+        self.local.statements = []
+        self.local.template_seconds = 0.0
+        for fixture in context["fixtures"]:
+            if isinstance(fixture, Template):
+                time_template(fixture)
+
+    def record_statement(self, sql, seconds):
+        if self.is_valid():
+            self.local.statements.append((sql, seconds))
+
+    def record_template(self, seconds):
+        if self.is_valid():
+            self.local.template_seconds += seconds
+
+    def on_success(self, context):
+        self.finish(context)
+
+    def on_error(self, context):
+        self.finish(context)
+
+    def finish(self, context):
+        if not self.is_valid():
+            return
+        local = self.local
+        self.local_delete(self)
+        total = time.perf_counter() - local.start
+        db_seconds = sum(seconds for sql, seconds in local.statements)
+        shapes = Counter(shape_of(sql) for sql, seconds in local.statements)
+        repeated = {
+            shape: count
+            for shape, count in shapes.items()
+            if count >= settings.QUERY_REPEAT_THRESHOLD
+        }
+        slow = [
+            (sql, seconds)
+            for sql, seconds in local.statements
+            if seconds * 1000 >= settings.SLOW_QUERY_MS
+        ]
+        record = dict(
+            method=request.method,
+            path=request.path,
+            status=context.get("status"),
+            statements=len(local.statements),
+            db_ms=round(db_seconds * 1000, 2),
+            template_ms=round(local.template_seconds * 1000, 2),
+            total_ms=round(total * 1000, 2),
+            repeated=repeated,
+            slow=[dict(sql=sql, ms=round(s * 1000, 2)) for sql, s in slow],
+        )
+        response.headers["Server-Timing"] = (
+            'db;dur=%(db_ms)s;desc="%(statements)s queries", '
+            "tpl;dur=%(template_ms)s, app;dur=%(total_ms)s" % record
+        )
+        logger.info("request %s", json.dumps(record, default=str))
+        for shape, count in repeated.items():
+            logger.warning(
+                "possible N+1 in %s: %s times %s", request.path, count, shape
+            )
+        for sql, seconds in slow:
+            logger.warning(
+                "slow query in %s: %.1fms %s", request.path, seconds * 1000, sql
+            )
+        with self.lock:
+            self.recent.append(record)
+
+    def stats(self):
+        with self.lock:
+            return list(reversed(self.recent))
+
+
+instrument = Instrumentation()
+
+
+class StatementTimer(ExecutionHandler):
+    """pydal execution handler reporting the statements to instrument"""
+
+    def before_execute(self, command):
+        self.start = time.perf_counter()
+
+    def after_execute(self, command):
+        instrument.record_statement(command, time.perf_counter() - self.start)
+
+
+db._adapter.execution_handlers.append(StatementTimer)
+
+
+def time_template(fixture):
+    """make the Template fixture report its render time, once"""
+    if getattr(fixture, "instrumented", False):
+        return
+    on_success = fixture.on_success
+
+    def timed_on_success(context):
+        start = time.perf_counter()
+        try:
+            return on_success(context)
+        finally:
+            instrument.record_template(time.perf_counter() - start)
+
+    fixture.on_success = timed_on_success
+    fixture.instrumented = True
@@ -0,0 +1,316 @@
+"""
+Local background jobs, no broker needed
+
+Jobs are rows of the job table. enqueue() inserts one as "queued" and a
+worker claims it with an UPDATE ... WHERE status = 'queued' that only one
+worker can win, runs the handler registered for its name (see tasks.py) and
+stores its result. A failing job is queued again after
+JOBS_RETRY_BACKOFF * 2 ** (attempt - 1) seconds until it ran max_attempts
+times, then it is "failed". Jobs left "running" by a worker that died are
+queued again after JOBS_TIMEOUT seconds. Handlers registered with every=
+are queued again by the workers once that many seconds passed since the
+last one.
+
+Workers are threads of the web process, JOBS_WORKERS of them started when
+py4web loads the app (not when commands.py imports it), and/or separate
+processes:
+
+    python -m apps.htmx_demo.commands worker [--threads N]
+
+the periodic jobs only run while some worker does, with JOBS_WORKERS = 0
+run at least one "commands worker" process.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+
+from .common import db, settings, logger
+from . import startup
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+handlers = {}
+#  name -> seconds between the runs of the periodic jobs
+periodic = {}
+
+
+def job_handler(name, every=None):
+    """
+    register the decorated function as the handler of the name jobs, queued
+    by the workers every that many seconds if given
+    """
+
+    def register(func):
+        handlers[name] = func
+        if every:
+            periodic[name] = every
+        return func
+
+    return register
+
+
+def now():
+    return datetime.datetime.now()
+
+
+def enqueue(name, max_attempts=None, delay=0, **args):
+    """
+    queue the name job, the handler is called with args; returns its id. It
+    is run by the workers of the web process or of "commands worker", never
+    by one started here: a command queueing a job exits without waiting
+    """
+    return insert_job(name, max_attempts, delay, args)
+
+
+def insert_job(name, max_attempts, delay, args):
+    if name not in handlers:
+        raise KeyError("no handler for job %r" % name)
+    return db.job.insert(
+        name=name,
+        args=args,
+        status=QUEUED,
+        attempts=0,
+        max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+        created_on=now(),
+        run_at=now() + datetime.timedelta(seconds=delay),
+    )
+
+
+def requeue_stale():
+    """queue again the jobs running for longer than JOBS_TIMEOUT"""
+    job = db.job
+    started = now() - datetime.timedelta(seconds=settings.JOBS_TIMEOUT)
+    return db((job.status == RUNNING) & (job.started_on < started)).update(
+        status=QUEUED, run_at=now()
+    )
+
+
+def schedule_periodic():
+    """queue the periodic jobs not queued since their interval"""
+    job = db.job
+    last = job.created_on.max()
+    for name, every in periodic.items():
+        created_on = db(job.name == name).select(last).first()[last]
+        if created_on is None or (now() - created_on).total_seconds() >= every:
+            insert_job(name, None, 0, {})
+
+
+def claim(worker_name):
+    """the next due job, marked as running by worker_name, or None"""
+    job = db.job
+    while True:
+        row = (
+            db((job.status == QUEUED) & (job.run_at <= now()))
+            .select(job.id, orderby=job.run_at | job.id, limitby=(0, 1))
+            .first()
+        )
+        if row is None:
+            return None
+        won = db((job.id == row.id) & (job.status == QUEUED)).update(
+            status=RUNNING,
+            worker=worker_name,
+            started_on=now(),
+            finished_on=None,
+            attempts=job.attempts + 1,
+        )
+        db.commit()
+        if won:
+            return job(row.id)
+
+
+def backoff(attempts):
+    return settings.JOBS_RETRY_BACKOFF * 2 ** max(attempts - 1, 0)
+
+
+def run(row):
+    """run the claimed job row, returns True if it succeeded"""
+    job = db.job
+    started = time.perf_counter()
+    try:
+        handler = handlers.get(row.name)
+        if handler is None:
+            raise KeyError("no handler for job %r" % row.name)
+        result = handler(**(row.args or {}))
+        db.commit()
+    except Exception:
+        db.rollback()
+        seconds = time.perf_counter() - started
+        retry = row.attempts < row.max_attempts and row.name in handlers
+        fields = dict(error=traceback.format_exc(), finished_on=now())
+        if retry:
+            delay = backoff(row.attempts)
+            fields.update(
+                status=QUEUED, run_at=now() + datetime.timedelta(seconds=delay)
+            )
+        else:
+            fields.update(status=FAILED)
+        db(job.id == row.id).update(**fields)
+        db.commit()
+        metrics.record(seconds, failed=not retry, retried=retry)
+        logger.warning(
+            "job %s %s attempt %s/%s failed%s",
+            row.id,
+            row.name,
+            row.attempts,
+            row.max_attempts,
+            ", retrying in %ss" % delay if retry else "",
+        )
+        return False
+
+    seconds = time.perf_counter() - started
+    db(job.id == row.id).update(
+        status=DONE, result=result, error=None, finished_on=now()
+    )
+    db.commit()
+    metrics.record(seconds)
+    logger.info("job %s %s done in %.2fs", row.id, row.name, seconds)
+    return True
+
+
+class Metrics:
+    """jobs run by the workers of this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+        self.busy_seconds = 0.0
+
+    def record(self, seconds, failed=False, retried=False):
+        with self.lock:
+            self.busy_seconds += seconds
+            if retried:
+                self.retried += 1
+            elif failed:
+                self.failed += 1
+            else:
+                self.done += 1
+
+    def as_dict(self):
+        uptime = time.time() - self.started
+        return dict(
+            done=self.done,
+            failed=self.failed,
+            retried=self.retried,
+            busy_seconds=round(self.busy_seconds, 3),
+            jobs_per_minute=round(self.done * 60 / uptime, 2) if uptime else None,
+        )
+
+
+metrics = Metrics()
+
+
+class Worker:
+    """a pool of threads running the queued jobs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self, threads=1):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            self.stopping.clear()
+            while len(self.threads) < threads:
+                name = "%s:%s:%s" % (
+                    socket.gethostname(),
+                    os.getpid(),
+                    len(self.threads),
+                )
+                thread = threading.Thread(target=self.loop, args=(name,), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, wait=True):
+        self.stopping.set()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def loop(self, name):
+        #  every thread has its own connection
+        db._adapter.reconnect()
+        last_check = 0
+        try:
+            while not self.stopping.is_set():
+                try:
+                    row = claim(name)
+                    if row is not None:
+                        run(row)
+                        continue
+                    if time.time() - last_check > 60:
+                        requeue_stale()
+                        schedule_periodic()
+                        db.commit()
+                        last_check = time.time()
+                except Exception:
+                    db.rollback()
+                    logger.exception("job worker %s", name)
+                self.stopping.wait(settings.JOBS_POLL_INTERVAL)
+        finally:
+            db.close()
+
+    def run_pending(self, name="once"):
+        """run the due jobs in this thread until there are none, returns how many"""
+        count = 0
+        requeue_stale()
+        schedule_periodic()
+        while True:
+            row = claim(name)
+            if row is None:
+                return count
+            run(row)
+            count += 1
+
+
+worker = Worker()
+
+
+def start_web_workers():
+    """start the JOBS_WORKERS threads of the web process, see startup.served()"""
+    if settings.JOBS_WORKERS and startup.served():
+        worker.start(settings.JOBS_WORKERS)
+
+
+def queue_stats():
+    """jobs per status, and the throughput of the last JOBS_METRICS_WINDOW seconds"""
+    job = db.job
+    count = job.id.count()
+    stats = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+    for row in db(job.id > 0).select(job.status, count, groupby=job.status):
+        stats[row.job.status] = row[count]
+
+    window = settings.JOBS_METRICS_WINDOW
+    since = now() - datetime.timedelta(seconds=window)
+    rows = db((job.status == DONE) & (job.finished_on >= since)).select(
+        job.started_on, job.finished_on
+    )
+    durations = [
+        (row.finished_on - row.started_on).total_seconds()
+        for row in rows
+        if row.started_on
+    ]
+    oldest = (
+        db((job.status == QUEUED) & (job.run_at <= now()))
+        .select(job.run_at.min())
+        .first()[job.run_at.min()]
+    )
+    stats.update(
+        window_seconds=window,
+        done_in_window=len(rows),
+        jobs_per_minute=round(len(rows) * 60 / window, 2),
+        average_seconds=(
+            round(sum(durations) / len(durations), 3) if durations else None
+        ),
+        oldest_due_seconds=(now() - oldest).total_seconds() if oldest else None,
+        workers=len([t for t in worker.threads if t.is_alive()]),
+        process=metrics.as_dict(),
+    )
+    return stats
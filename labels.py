@@ -0,0 +1,140 @@
+"""
+Batched lookup of the labels of referenced records, the text the autocomplete
+widgets show for their current value
+
+Widgets register the (table, id) they need while the form is built and get a
+LazyLabel back; the first label rendered resolves every pending id of its
+table with a single belongs query. Forms are built as their template renders,
+once the db fixture committed and gave the request's connection back, so
+that query borrows one from the pool and returns it (database.connection). Labels are memoized for the request and,
+when LABEL_CACHE_TTL is set, shared across requests by a small LRU that is
+invalidated by the write generations of fragments.py.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from py4web import request
+from yatl.sanitizer import xmlescape
+
+from .common import db, settings
+from .database import connection
+from .fragments import generations, written
+
+
+def label_fields(table, label):
+    """the fields needed to render label, so autocomplete selects only those"""
+    names = re.findall(r"%\((\w+)\)", label) if isinstance(label, str) else []
+    if not names or any(name not in table.fields for name in names):
+        return [f for f in table]
+    return [table.id] + [table[name] for name in names if name != "id"]
+
+
+class LabelCache:
+    """thread safe LRU of labels with a time to live"""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items[key] = (time.time() + ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+label_cache = LabelCache()
+
+
+class LazyLabel:
+    """renders (escaped) as the label of a record once it is resolved"""
+
+    def __init__(self, resolver, group, row_id):
+        self.resolver = resolver
+        self.group = group
+        self.row_id = row_id
+
+    def __str__(self):
+        return xmlescape(self.resolver.label(self.group, self.row_id) or "")
+
+
+class LabelResolver:
+    def __init__(self):
+        #  (tablename, fieldname, label format) -> pending ids
+        self.pending = defaultdict(set)
+        self.labels = {}
+
+    def register(self, requires, value):
+        group = (requires.ktable, requires.kfield, requires.label)
+        try:
+            row_id = int(value)
+        except (TypeError, ValueError):
+            return None
+        if (group, row_id) not in self.labels:
+            self.pending[group].add(row_id)
+        return LazyLabel(self, group, row_id)
+
+    def label(self, group, row_id):
+        if (group, row_id) not in self.labels:
+            self.resolve(group)
+        return self.labels.get((group, row_id))
+
+    def _shared_key(self, group, row_id):
+        return group + (row_id, generations[group[0]])
+
+    def resolve(self, group):
+        ids = self.pending.pop(group, set())
+        ttl = settings.LABEL_CACHE_TTL
+        #  not shared while this thread has uncommitted writes to the table
+        if written(group[0]):
+            ttl = 0
+        if ttl:
+            for row_id in list(ids):
+                label = label_cache.get(self._shared_key(group, row_id))
+                if label is not None:
+                    self.labels[(group, row_id)] = label
+                    ids.discard(row_id)
+        if not ids:
+            return
+
+        tablename, fieldname, label = group
+        table = db[tablename]
+        fields = label_fields(table, label)
+        if fieldname not in [f.name for f in fields]:
+            fields.append(table[fieldname])
+        #  rendering the template, after the db fixture released its connection
+        with connection(db):
+            rows = db(table[fieldname].belongs(ids)).select(*fields)
+        for row in rows:
+            text = label(row) if callable(label) else label % row
+            self.labels[(group, row[fieldname])] = text
+            if ttl:
+                label_cache.set(self._shared_key(group, row[fieldname]), text, ttl)
+
+
+def label_resolver():
+    """the LabelResolver of the current request"""
+    try:
+        environ = request.environ
+    except (AttributeError, RuntimeError):
+        return LabelResolver()
+    resolver = environ.get("htmx_demo.labels")
+    if resolver is None:
+        resolver = environ["htmx_demo.labels"] = LabelResolver()
+    return resolver
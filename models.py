@@ -2,92 +2,310 @@
 This file defines the database models
 """
 
-from .common import db, Field
+import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+
+from .common import db, Field, settings
+from . import startup
 from pydal.validators import *
 
 from .htmx import autocomplete_widget
+from .references import IS_IN_DB_LAZY
+from .search import register_index, register_fts_index
+from .fragments import track_writes
+from .aggregates import track_parents
+from .summaries import (
+    track_customer_summaries,
+    rebuild_customer_summaries,
+    apply_summary_delta,
+)
+from .repricing import track_product_prices
+from . import versions, aggregates, fragments
+from .totals import (
+    delta_mode,
+    apply_total_delta,
+    line_deltas,
+    deleted_line_deltas,
+    recompute_order_totals,
+    as_decimal,
+    line_price,
+)
 
 db.define_table(
     "product",
     Field("name"),
     Field("price", "decimal(9,2)", requires=IS_DECIMAL_IN_RANGE(0, 9999)),
 )
+register_index(db.product, ["name"])
+register_fts_index(db.product, ["name"])
+track_writes(db.product)
+versions.track_writes(db.product)
+track_product_prices()
 
 
 db.define_table("customer", Field("name"), Field("city"), Field("state"))
+register_fts_index(db.customer, ["name", "city", "state"])
+track_writes(db.customer)
+versions.track_writes(db.customer)
 
+#  the reference fields check their value with one lookup and are shown
+#  with the autocomplete widget instead of listing the table, see references.py
 db.define_table(
     "order",
     Field(
         "customer",
         "reference customer",
-        requires=IS_IN_DB(db, "customer.id", "%(name)s", zero=".."),
+        requires=IS_IN_DB_LAZY(db, "customer.id", "%(name)s", zero=".."),
     ),
     Field("total", "decimal(11,2)"),
+    Field(
+        "created_on",
+        "datetime",
+        default=datetime.datetime.now,
+        readable=False,
+        writable=False,
+    ),
 )
+track_writes(db.order)
+track_parents(db.order, "customer")
+
+#  materialized per customer aggregates, see summaries.py
+db.define_table(
+    "customer_summary",
+    Field("customer", "reference customer", unique=True),
+    Field("order_count", "integer", default=0),
+    Field("lifetime_total", "decimal(13,2)", default=0),
+    Field("last_order_id", "integer"),
+)
+track_customer_summaries()
 
 db.define_table(
     "order_line",
     Field(
         "order",
         "reference order",
-        requires=IS_IN_DB(db, "order.id", "%(id)s", zero=".."),
+        requires=IS_IN_DB_LAZY(db, "order.id", "%(id)s", zero=".."),
     ),
     Field(
         "product",
         "reference product",
-        requires=IS_IN_DB(db, "product.id", "%(name)s", zero=".."),
+        requires=IS_IN_DB_LAZY(db, "product.id", "%(name)s", zero=".."),
         # widget=autocomplete_widget,
         _autocomplete_search_fields=["name"],
     ),
     Field("price", "decimal(9,2)"),
-    Field("quantity", "decimal(7,2)"),
+    #  at most 1000 so that, at a product price up to 9999, the line price
+    #  still fits its decimal(9,2)
+    Field("quantity", "decimal(7,2)", requires=IS_DECIMAL_IN_RANGE(0, 1000)),
 )
+track_parents(db.order_line, "order")
+
+#  queue of the background jobs, see jobs.py
+db.define_table(
+    "job",
+    Field("name"),
+    Field("args", "json"),
+    Field("status", default="queued"),
+    Field("attempts", "integer", default=0),
+    Field("max_attempts", "integer", default=3),
+    Field("created_on", "datetime"),
+    Field("run_at", "datetime"),
+    Field("started_on", "datetime"),
+    Field("finished_on", "datetime"),
+    Field("worker"),
+    Field("result", "json"),
+    Field("error", "text"),
+)
+
+#  versions of the data the htmx fragments show, for their ETags, see versions.py
+db.define_table(
+    "data_version",
+    Field("name", unique=True),
+    Field("version", "integer", default=0),
+)
+
+
+startup.mark("models")
+
+
+_order_line_hooks = threading.local()
+
+
+@contextmanager
+def order_line_hooks_suspended():
+    """skip the per row order_line pricing and total hooks in this thread"""
+    _order_line_hooks.suspended = True
+    try:
+        yield
+    finally:
+        _order_line_hooks.suspended = False
+
+
+def order_line_hooks_active():
+    return not getattr(_order_line_hooks, "suspended", False)
 
 
 def order_line_before_update(set, fields):
-    if fields:
+    if fields and order_line_hooks_active():
         quantity = fields.get("quantity")
         product_id = fields.get("product")
         product = db.product(product_id)
-        if quantity and product and product.price:
-            price = quantity * product.price
-        else:
-            price = 0
+        fields["price"] = line_price(quantity, product and product.price)
+
 
-        fields["price"] = price
+def apply_order_deltas(deltas):
+    """
+    add the {order id: delta} deltas to order.total and to the lifetime_total
+    of their customers: the order hooks would select every order three times
+    and bump its versions, here the customers are selected once and the
+    versions bumped once
+    """
+    deltas = {int(i): as_decimal(delta) for i, delta in deltas.items() if i}
+    deltas = {order_id: delta for order_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    rows = db(db.order.id.belongs(deltas)).select(db.order.id, db.order.customer)
+    customers = {row.id: row.customer for row in rows}
+    customer_deltas = defaultdict(Decimal)
+    for order_id, delta in deltas.items():
+        apply_total_delta(order_id, delta)
+        customer_deltas[customers.get(order_id)] += delta
+    for customer_id, delta in customer_deltas.items():
+        apply_summary_delta(customer_id, total=delta)
+    aggregates.invalidate("order", *customer_deltas)
+    fragments.bump("order")
 
 
-def order_line_after_update(fields, key_id):
-    order_id = fields.get("order")
+def order_line_after_insert(fields, key_id):
+    if not order_line_hooks_active():
+        return
+    if delta_mode():
+        apply_order_deltas({fields.get("order"): fields.get("price")})
+    else:
+        recompute_order_totals([fields.get("order")])
 
-    #  get order total
-    total = (
-        db(db.order_line.order == order_id)
-        .select(db.order_line.price.sum())
-        .first()[db.order_line.price.sum()]
-    )
 
-    order = db.order(order_id)
-    order.update_record(total=total)
+def order_line_before_update_total(s, fields):
+    if delta_mode() and order_line_hooks_active():
+        rows = db(s.query).select(db.order_line.order, db.order_line.price)
+        apply_order_deltas(line_deltas(rows, fields))
+
+
+def order_line_after_update(s, fields):
+    if not delta_mode() and order_line_hooks_active():
+        rows = db(s.query).select(db.order_line.order, distinct=True)
+        recompute_order_totals([fields.get("order")] + [r.order for r in rows])
 
 
 def order_line_before_delete(s):
-    for row in db(s.query).select():
-        #  update the order total not including this record
-        total = (
-            db((db.order_line.order == row.order) & (db.order_line.id != row.id))
-            .select(db.order_line.price.sum())
-            .first()[db.order_line.price.sum()]
-        )
-        order = db.order(row.order)
-        order.update_record(total=total)
+    if not order_line_hooks_active():
+        return
+    if delta_mode():
+        apply_order_deltas(deleted_line_deltas(s))
+    else:
+        #  re-sum the affected orders not including the deleted lines
+        rows = db(s.query).select(db.order_line.order, distinct=True)
+        recompute_order_totals([r.order for r in rows], exclude=s.query)
 
 
 db.order_line._before_insert.append(lambda f: order_line_before_update("", f))
 db.order_line._before_update.append(lambda s, f: order_line_before_update(s, f))
-db.order_line._after_insert.append(lambda f, i: order_line_after_update(f, i))
-db.order_line._after_update.append(lambda s, f: order_line_after_update(f, 0))
+db.order_line._before_update.append(lambda s, f: order_line_before_update_total(s, f))
+db.order_line._after_insert.append(lambda f, i: order_line_after_insert(f, i))
+db.order_line._after_update.append(lambda s, f: order_line_after_update(s, f))
 db.order_line._before_delete.append(lambda s: order_line_before_delete(s))
 
-db.commit()
+
+INDEXES = [
+    ("order_line", ["order", "product"]),
+    ("order", ["customer"]),
+    ("order", ["created_on"]),
+    ("product", ["name"]),
+    ("customer", ["name"]),
+    ("customer_summary", ["lifetime_total"]),
+    ("job", ["status", "run_at"]),
+]
+
+
+def create_indexes():
+    """create the INDEXES supporting the autocomplete and grid queries"""
+    for tablename, fieldnames in INDEXES:
+        table = db[tablename]
+        db.executesql(
+            "CREATE INDEX IF NOT EXISTS %s ON %s (%s);"
+            % (
+                "%s__%s_idx" % (tablename, "_".join(fieldnames)),
+                table._rname,
+                ", ".join(table[name]._rname for name in fieldnames),
+            )
+        )
+
+
+#  skipped by the production profile when the schema did not change
+if startup.MIGRATE:
+    create_indexes()
+    #  fill customer_summary when it was just created on an existing database
+    if db(db.customer_summary).isempty() and not db(db.customer).isempty():
+        rebuild_customer_summaries()
+    db.commit()
+    startup.schema_migrated()
+startup.mark("migrations")
+
+
+def bulk_insert_order_lines(lines, order_id):
+    """
+    insert many order lines into the order_id order at once: lines is an
+    iterable of dicts with product and quantity
+
+    product prices are fetched with one query, the per row hooks are
+    suspended and every affected order.total is updated once at the end
+    returns the list of the new order_line ids, raises ValueError when a
+    quantity is refused by the order_line.quantity validator or a product
+    does not exist
+    """
+    items = []
+    for number, line in enumerate(lines, start=1):
+        quantity, error = db.order_line.quantity.validate(line.get("quantity"))
+        if not error and quantity is None:
+            error = "Enter a quantity"
+        if error:
+            raise ValueError(
+                "line %s: quantity %r: %s" % (number, line.get("quantity"), error)
+            )
+        items.append(
+            dict(
+                order=int(order_id),
+                product=int(line["product"]),
+                quantity=as_decimal(quantity),
+            )
+        )
+    if not items:
+        return []
+
+    product_ids = {item["product"] for item in items}
+    prices = {
+        row.id: row.price
+        for row in db(db.product.id.belongs(product_ids)).select(
+            db.product.id, db.product.price
+        )
+    }
+    missing = product_ids - set(prices)
+    if missing:
+        raise ValueError("unknown product(s): %s" % sorted(missing))
+
+    deltas = defaultdict(Decimal)
+    for item in items:
+        item["price"] = line_price(item["quantity"], prices[item["product"]])
+        deltas[item["order"]] += item["price"]
+
+    with order_line_hooks_suspended(), versions.batched():
+        ids = db.order_line.bulk_insert(items)
+
+    if delta_mode():
+        apply_order_deltas(deltas)
+    else:
+        recompute_order_totals(deltas)
+    return ids
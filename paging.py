@@ -0,0 +1,197 @@
+"""
+Keyset (seek) pagination for the grids
+
+With GRID_PAGING = "keyset" a KeysetGrid does not page with OFFSET: the
+after/before cursor in the url (the key values of the last/first row shown)
+is turned into a query matching only the rows of the requested page, found
+through the index on the keys, so page 5,000 costs the same as page 1. The
+total shown in the footer comes from a cached COUNT(*) (GRID_COUNT_TTL) and
+the row numbers are carried along in the links, so both are approximate.
+
+Sorting by a column or searching falls back to the regular offset paging.
+"""
+
+import base64
+import json
+
+from py4web import request, URL
+from py4web.utils.grid import Grid
+from yatl.helpers import A, DIV
+
+from .common import cache, settings
+from .fragments import generations, written
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def _beyond(key, value, greater):
+    """key > value (or key < value), NULLs sorting first as SQLite does"""
+    if value is None:
+        return (key != None) if greater else None
+    return (key > value) if greater else ((key < value) | (key == None))
+
+
+def _compare(keys, values, greater, inclusive=False):
+    """
+    (k1, k2, ...) > (v1, v2, ...) as a query, >= if inclusive; the last key
+    must be unique and not null (the id)
+    """
+    keys, values = list(keys), list(values)
+    last = keys[-1]
+    if inclusive:
+        query = (last >= values[-1]) if greater else (last <= values[-1])
+    else:
+        query = (last > values[-1]) if greater else (last < values[-1])
+    for key, value in reversed(list(zip(keys[:-1], values[:-1]))):
+        beyond = _beyond(key, value, greater)
+        tie = (key == value) & query
+        query = tie if beyond is None else beyond | tie
+    return query
+
+
+def key_greater(keys, values, inclusive=False):
+    return _compare(keys, values, True, inclusive)
+
+
+def key_less(keys, values, inclusive=False):
+    return _compare(keys, values, False, inclusive)
+
+
+def cached_count(query, tablename):
+    """
+    COUNT(*) of query, cached for GRID_COUNT_TTL seconds or until the next
+    committed write to tablename
+    """
+    if not settings.GRID_COUNT_TTL or written(tablename):
+        return query._db(query).count()
+    return cache.get(
+        ("grid_count", str(query), generations[tablename]),
+        lambda: query._db(query).count(),
+        settings.GRID_COUNT_TTL,
+    )
+
+
+def keyset_enabled():
+    params = request.query
+    return (
+        settings.GRID_PAGING == "keyset"
+        and params.get("mode", "select") == "select"
+        and not params.get("search_string")
+        and not params.get("orderby")
+    )
+
+
+class KeysetGrid(Grid):
+    """a Grid paging on keys (fields with a unique combination of values)"""
+
+    def __init__(self, keys, query, rows_per_page=15, count=None, **kwargs):
+        self.keys = keys
+        #  optional callable returning the number of rows of query
+        self.count = count
+        self.base_query = query
+        self.keyset = keyset_enabled()
+        if self.keyset:
+            query = self._seek(query, rows_per_page)
+            kwargs["orderby"] = keys
+        super().__init__(query=query, rows_per_page=rows_per_page, **kwargs)
+
+    def _key(self, row):
+        return [row[key] for key in self.keys]
+
+    def _seek(self, query, rows_per_page):
+        """the query of the rows of the requested page"""
+        db = query._db
+        after = decode_cursor(request.query.get("after", ""))
+        before = decode_cursor(request.query.get("before", ""))
+        try:
+            self.first_row = max(int(request.query.get("start", 0)), 0)
+        except ValueError:
+            self.first_row = 0
+        limitby = (0, rows_per_page + 1)
+
+        if before:
+            rows = db(query & key_less(self.keys, before)).select(
+                *self.keys, orderby=[~key for key in self.keys], limitby=limitby
+            )
+            self.has_previous = len(rows) > rows_per_page
+            self.has_next = True
+            if not self.has_previous:
+                self.first_row = 0
+            rows = list(rows)[:rows_per_page]
+            if not rows:
+                return query & key_less(self.keys, before)
+            self.first_key, self.last_key = self._key(rows[-1]), self._key(rows[0])
+        else:
+            if after:
+                query &= key_greater(self.keys, after)
+            rows = db(query).select(*self.keys, orderby=self.keys, limitby=limitby)
+            self.has_previous = bool(after)
+            self.has_next = len(rows) > rows_per_page
+            rows = list(rows)[:rows_per_page]
+            if not rows:
+                return query
+            self.first_key, self.last_key = self._key(rows[0]), self._key(rows[-1])
+
+        return (
+            query
+            & key_greater(self.keys, self.first_key, inclusive=True)
+            & key_less(self.keys, self.last_key, inclusive=True)
+        )
+
+    def process(self):
+        super().process()
+        if self.keyset and self.mode == "select":
+            rows = len(self.rows)
+            if self.count:
+                total = self.count()
+            else:
+                total = cached_count(self.base_query, self.keys[0].tablename)
+            self.total_number_of_rows = max(total, self.first_row + rows)
+            self.page_start = self.first_row
+            self.page_end = self.first_row + rows
+            #  the pager is only rendered when there is more than one page
+            more = rows and (self.has_previous or self.has_next)
+            self.number_of_pages = 2 if more else (1 if rows else 0)
+
+    def _make_table_pager(self):
+        if not self.keyset:
+            return super()._make_table_pager()
+        pager = DIV(_class=self.get_style("grid-pagination"))
+        params = {
+            k: v
+            for k, v in dict(self.query_parms).items()
+            if k not in ("after", "before", "start", "page")
+        }
+        if self.has_previous:
+            vars = dict(params, before=encode_cursor(self.first_key))
+            vars["start"] = max(self.first_row - self.param.rows_per_page, 0)
+            pager.append(
+                A(
+                    "Previous",
+                    _class=self.get_style("grid-pagination-button"),
+                    _role="button",
+                    _href=URL(vars=vars),
+                )
+            )
+        if self.has_next:
+            vars = dict(params, after=encode_cursor(self.last_key))
+            vars["start"] = self.first_row + len(self.rows)
+            pager.append(
+                A(
+                    "Next",
+                    _class=self.get_style("grid-pagination-button"),
+                    _role="button",
+                    _href=URL(vars=vars),
+                )
+            )
+        return pager
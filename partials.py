@@ -0,0 +1,47 @@
+"""
+Partial rendering of the pages for htmx requests
+
+The pages extending layout.html keep their content in templates/htmx/ and
+wrap it in a #page-content element boosting its links and forms into itself.
+Those htmx requests (HX-Request with HX-Target: page-content) get the content
+template alone: no layout, navbar, stylesheets or scripts to render and send
+only for htmx to throw them away. Everything else, including the history
+restore requests of htmx, gets the full page.
+
+Templates are compiled once and cached by py4web's render, for both the
+pages and their partials.
+"""
+
+from py4web import request, response
+from py4web.core import Template
+
+PAGE_TARGET = "page-content"
+
+
+def is_partial(target=PAGE_TARGET):
+    """True when the request is an htmx request swapping into target"""
+    headers = request.headers
+    return (
+        headers.get("HX-Request") == "true"
+        and headers.get("HX-Target") == target
+        and not headers.get("HX-History-Restore-Request")
+    )
+
+
+class Page(Template):
+    """
+    Template fixture rendering filename, or only partial (by default
+    htmx/<filename>) for the htmx requests targeting the page content
+    """
+
+    def __init__(self, filename, partial=None, target=PAGE_TARGET):
+        super().__init__(filename)
+        self.partial = Template(partial or "htmx/" + filename)
+        self.target = target
+
+    def on_success(self, context):
+        #  the same url answers with two bodies
+        response.headers["Vary"] = "HX-Request, HX-Target"
+        if is_partial(self.target):
+            return self.partial.on_success(context)
+        return super().on_success(context)
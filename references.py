@@ -0,0 +1,53 @@
+"""
+Reference fields to large tables
+
+IS_IN_DB lists the whole referenced table: every form showing the field
+builds a <select> with one <option> per customer, product, ... and validates
+the posted value against that list. IS_IN_DB_LAZY never enumerates the
+table, it has no options and checks the posted id with a single indexed
+lookup, while keeping the ktable, kfield and label the autocomplete widgets
+read. Forms built with autocomplete_formstyle() show those fields with the
+htmx autocomplete widget of htmx.py.
+"""
+
+from py4web.utils.form import FormStyleBulma, FormStyleFactory
+from pydal.validators import IS_IN_DB, ValidationError, validator_caller
+
+from .htmx import NewHtmxAutocompleteWidget
+
+
+class IS_IN_DB_LAZY(IS_IN_DB):
+    """IS_IN_DB checking one value at a time, without options"""
+
+    #  py4web forms pick a <select> for the validators having options
+    options = None
+
+    def validate(self, value, record_id=None):
+        if self.multiple or self.auto_add:
+            return super().validate(value, record_id)
+        field = self.dbset.db[self.ktable][self.kfield]
+        if field.type in ("id", "integer"):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValidationError(self.translator(self.error_message))
+        if self.dbset(field == value).isempty():
+            raise ValidationError(self.translator(self.error_message))
+        if self._and:
+            return validator_caller(self._and, value, record_id)
+        return value
+
+
+def autocomplete_formstyle(table, formstyle=FormStyleBulma, **widgets):
+    """
+    a copy of formstyle showing the IS_IN_DB_LAZY fields of table with the
+    autocomplete widget, or with the widget given for their name
+    """
+    style = FormStyleFactory()
+    style.classes = formstyle.classes
+    style.class_inner_exceptions = formstyle.class_inner_exceptions
+    for field in table:
+        if isinstance(field.requires, IS_IN_DB_LAZY):
+            style.widgets[field.name] = NewHtmxAutocompleteWidget()
+    style.widgets.update(widgets)
+    return style
@@ -0,0 +1,179 @@
+"""
+Repricing of the order lines when product prices change
+
+order_line.price is quantity * product.price computed by the order_line
+hooks when the line is written, so a catalog price change would leave the
+existing lines stale. reprice() fixes them set based, whatever their number:
+
+1. one UPDATE of the lines, joined to their product by a subquery
+2. one UPDATE of the totals of the orders having those lines, each summed
+   by a correlated (grouped) aggregate
+3. one UPDATE of the lifetime totals of their customers' summaries
+
+bypassing the per row hooks, then invalidates the caches those would have.
+
+Every line of the repriced products is updated, those of old orders too:
+orders have no open/closed state here, and a line written for any reason
+(a quantity edit of a year old order included) gets the current price from
+the hook anyway. Repricing only the recent orders would leave the others to
+change whenever someone touches one of their lines. Orders meant to keep the
+prices they were placed at need a state (or a price snapshot) first, which
+reprice() would then filter on.
+
+A price change made through the product hooks reprices inline when it
+touches at most REPRICE_INLINE_LINES lines, else it queues a reprice-lines
+job (see tasks.py). Batches of price changes (e.g. a catalog import) run in
+batched_repricing() and are repriced once at its end.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from pydal.objects import Expression
+
+from .common import db, settings
+from .jobs import enqueue
+from .totals import as_decimal
+from . import aggregates, fragments
+
+_batch = threading.local()
+
+
+def reprice(product_ids=None):
+    """
+    reprice the lines of the product_ids products (of every product when
+    None) and the totals depending on them; returns (lines, orders) updated
+    """
+    line, order, summary = db.order_line, db.order, db.customer_summary
+    if product_ids is None:
+        query = line.id > 0
+    else:
+        query = line.product.belongs(sorted({int(i) for i in product_ids}))
+    orders = db(query)._select(line.order, distinct=True)
+    order_ids = [row[0] for row in db.executesql(orders)]
+    customers = db(order.id.belongs(orders))._select(order.customer, distinct=True)
+    customer_ids = [row[0] for row in db.executesql(customers)]
+    names = dict(
+        line=line._rname,
+        line_order=line.order._rname,
+        line_product=line.product._rname,
+        line_price=line.price._rname,
+        quantity=line.quantity._rname,
+        product=db.product._rname,
+        product_id=db.product.id._rname,
+        product_price=db.product.price._rname,
+        order=order._rname,
+        order_id=order.id._rname,
+        order_total=order.total._rname,
+        order_customer=order.customer._rname,
+        summary=summary._rname,
+        summary_customer=summary.customer._rname,
+        lifetime_total=summary.lifetime_total._rname,
+    )
+
+    #  totals.line_price() in SQL: quantity and unit price in whole cents,
+    #  their product rounded half up to cents with integer arithmetic, as
+    #  ROUND() on floats would round 2.675 down
+    unit_price = (
+        "(SELECT %(product)s.%(product_price)s FROM %(product)s "
+        "WHERE %(product)s.%(product_id)s = %(line)s.%(line_product)s)" % names
+    )
+    product = (
+        "(CAST(ROUND(COALESCE(%s, 0) * 100) AS INTEGER) * "
+        "CAST(ROUND(COALESCE(%s, 0) * 100) AS INTEGER))"
+        % (names["quantity"], unit_price)
+    )
+    db.executesql(
+        "UPDATE %(line)s SET %(line_price)s = (CASE WHEN %(product)s < 0 "
+        "THEN -((-%(product)s + 50) / 100) ELSE (%(product)s + 50) / 100 END) "
+        "/ 100.0 WHERE %(where)s;" % dict(names, product=product, where=query)
+    )
+    lines = db._adapter.cursor.rowcount
+    if not order_ids:
+        return lines, 0
+
+    db.executesql(
+        "UPDATE %(order)s SET %(order_total)s = COALESCE((SELECT "
+        "SUM(%(line)s.%(line_price)s) FROM %(line)s WHERE "
+        "%(line)s.%(line_order)s = %(order)s.%(order_id)s), 0) "
+        "WHERE %(order)s.%(order_id)s IN (%(orders)s);"
+        % dict(names, orders=orders.rstrip(";"))
+    )
+    db.executesql(
+        "UPDATE %(summary)s SET %(lifetime_total)s = COALESCE((SELECT "
+        "SUM(%(order)s.%(order_total)s) FROM %(order)s WHERE "
+        "%(order)s.%(order_customer)s = %(summary)s.%(summary_customer)s), 0) "
+        "WHERE %(summary)s.%(summary_customer)s IN (%(customers)s);"
+        % dict(names, customers=customers.rstrip(";"))
+    )
+
+    #  what the order_line and order hooks would have done
+    aggregates.invalidate("order_line", *order_ids)
+    aggregates.invalidate("order", *customer_ids)
+    fragments.bump("order_line", "order", "customer_summary")
+    return lines, len(order_ids)
+
+
+def reprice_products(product_ids):
+    """reprice now, or in a job when the change touches too many lines"""
+    limit = settings.REPRICE_INLINE_LINES
+    if limit is not None:
+        if len(product_ids) > limit:
+            #  most of the catalog, reprice it all
+            return enqueue("reprice-lines", product_ids=None)
+        if db(db.order_line.product.belongs(product_ids)).count() > limit:
+            return enqueue("reprice-lines", product_ids=sorted(product_ids))
+    reprice(product_ids)
+
+
+@contextmanager
+def batched_repricing():
+    """reprice the products whose price changes in the block once, at its end"""
+    if getattr(_batch, "product_ids", None) is not None:
+        yield
+        return
+    _batch.product_ids = set()
+    try:
+        yield
+        product_ids = _batch.product_ids
+    finally:
+        _batch.product_ids = None
+    if product_ids:
+        reprice_products(product_ids)
+
+
+def prices_changed(product_ids):
+    if getattr(_batch, "product_ids", None) is not None:
+        _batch.product_ids.update(product_ids)
+    else:
+        reprice_products(product_ids)
+
+
+def track_product_prices():
+    """reprice the order lines from the product hooks"""
+
+    def before_update(s, fields):
+        if "price" not in fields:
+            return
+        rows = db(s.query).select(db.product.id, db.product.price)
+        if isinstance(fields["price"], Expression):
+            #  e.g. price * 1.1, the new prices are only known after the update
+            s.old_prices = {row.id: as_decimal(row.price) for row in rows}
+            return
+        price = as_decimal(fields["price"])
+        s.repriced_products = [row.id for row in rows if as_decimal(row.price) != price]
+
+    def after_update(s, fields):
+        old_prices = getattr(s, "old_prices", None)
+        if old_prices:
+            rows = db(db.product.id.belongs(list(old_prices))).select(
+                db.product.id, db.product.price
+            )
+            s.repriced_products = [
+                row.id for row in rows if as_decimal(row.price) != old_prices[row.id]
+            ]
+        if getattr(s, "repriced_products", None):
+            prices_changed(s.repriced_products)
+
+    db.product._before_update.append(before_update)
+    db.product._after_update.append(after_update)
@@ -0,0 +1,313 @@
+"""
+Search indexes used by the autocomplete endpoints, SEARCH_BACKEND picks one:
+
+"memory": an in-process word prefix index
+
+Every word of the indexed fields is kept in one sorted list of
+(word, label, id) entries, so the rows whose words start with a search term
+are a contiguous slice found with bisect. Results come out ranked by the
+matched word (exact words before longer completions) and then by label, which
+lets a search stop as soon as it has enough ids.
+
+Indexes are built on first use, or when py4web loads the app with the
+production STARTUP_PROFILE, and kept up to date by the table hooks of the
+same process: the changes of a transaction are applied once it commits and
+dropped if it rolls back (see transactions.py). Writes from other processes
+(or ones that bypass the hooks, like importer.py) are picked up after
+invalidate() or SEARCH_INDEX_TTL.
+
+"fts5": an SQLite FTS5 virtual table per indexed table (<table>_fts), kept in
+sync by SQL triggers so it also sees writes from other processes and raw SQL.
+"""
+
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from .common import db, settings, logger
+from . import startup
+from .transactions import on_commit, pending
+
+WORDS = re.compile(r"\w+", re.UNICODE)
+
+
+def words_of(text):
+    return WORDS.findall(str(text or "").lower())
+
+
+class PrefixIndex:
+    def __init__(self, table, fieldnames):
+        self.table = table
+        self.fieldnames = list(fieldnames)
+        self.lock = threading.RLock()
+        self.entries = []
+        self.rows = {}
+        self.built_on = None
+
+    def _text(self, row):
+        return " ".join(str(row.get(name) or "") for name in self.fieldnames)
+
+    def _entries_of(self, row_id, text):
+        label = text.lower()
+        return {(word, label, row_id) for word in words_of(text)}
+
+    def build(self):
+        db = self.table._db
+        fields = [self.table[name] for name in self.fieldnames]
+        sql = db(self.table.id > 0)._select(self.table.id, *fields)
+        entries, rows = [], {}
+        for record in db.executesql(sql):
+            row_id, text = record[0], " ".join(str(v or "") for v in record[1:])
+            rows[row_id] = text
+            entries.extend(self._entries_of(row_id, text))
+        entries.sort()
+        with self.lock:
+            self.entries, self.rows = entries, rows
+            self.built_on = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.built_on = None
+
+    def is_stale(self):
+        if self.built_on is None:
+            return True
+        ttl = settings.SEARCH_INDEX_TTL
+        return bool(ttl) and time.time() - self.built_on > ttl
+
+    def ensure_built(self):
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale():
+                    self.build()
+
+    def add(self, row_id, row):
+        if self.built_on is None:
+            return
+        text = self._text(row)
+        with self.lock:
+            self.remove(row_id)
+            self.rows[row_id] = text
+            for entry in self._entries_of(row_id, text):
+                insort(self.entries, entry)
+
+    def remove(self, row_id):
+        if self.built_on is None:
+            return
+        with self.lock:
+            text = self.rows.pop(row_id, None)
+            if text is None:
+                return
+            for entry in self._entries_of(row_id, text):
+                position = bisect_left(self.entries, entry)
+                if position < len(self.entries) and self.entries[position] == entry:
+                    del self.entries[position]
+
+    def search(self, term, limit=None, exclude=()):
+        """
+        ids of the rows having, for every word of term, a word starting with
+        it; ranked best first and at most limit of them
+        """
+        terms = words_of(term)
+        if not terms:
+            return []
+        self.ensure_built()
+        #  scan the range of the longest term, check the others on the row
+        terms.sort(key=len, reverse=True)
+        first, others = terms[0], terms[1:]
+        ids, seen = [], set(exclude)
+        with self.lock:
+            entries = self.entries
+            position = bisect_left(entries, (first,))
+            while position < len(entries):
+                word, label, row_id = entries[position]
+                position += 1
+                if not word.startswith(first):
+                    break
+                if row_id in seen:
+                    continue
+                seen.add(row_id)
+                if others:
+                    row_words = words_of(label)
+                    if not all(any(w.startswith(t) for w in row_words) for t in others):
+                        continue
+                ids.append(row_id)
+                if limit and len(ids) >= limit:
+                    break
+        return ids
+
+
+class FtsIndex:
+    """PrefixIndex lookalike backed by an SQLite FTS5 external content table"""
+
+    def __init__(self, table, fieldnames):
+        self.table = table
+        self.fieldnames = list(fieldnames)
+        self.name = table._tablename + "_fts"
+
+    def _sql(self, template):
+        new = ", ".join("new.%s" % name for name in self.fieldnames)
+        old = ", ".join("old.%s" % name for name in self.fieldnames)
+        return template % dict(
+            fts=self.name,
+            table=self.table._tablename,
+            columns=", ".join(self.fieldnames),
+            new=new,
+            old=old,
+        )
+
+    def setup(self):
+        """create the virtual table and its triggers, filling it if it is new"""
+        db = self.table._db
+        exists = db.executesql(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
+            placeholders=[self.name],
+        )
+        for statement in self.DDL:
+            db.executesql(self._sql(statement))
+        if not exists:
+            self.build()
+
+    def build(self):
+        self.table._db.executesql(
+            self._sql("INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild');")
+        )
+
+    def invalidate(self):
+        pass
+
+    def search(self, term, limit=None, exclude=()):
+        """
+        ids of the rows matching every word of term as a prefix, in id order:
+        ordering by rank would score every match before applying the limit
+        """
+        terms = words_of(term)
+        if not terms:
+            return []
+        sql = "SELECT rowid FROM %s WHERE %s MATCH ?" % (self.name, self.name)
+        if exclude:
+            sql += " AND rowid NOT IN (%s)" % ", ".join(str(int(i)) for i in exclude)
+        if limit:
+            sql += " LIMIT %d" % limit
+        match = " AND ".join('"%s"*' % t for t in terms)
+        return [r[0] for r in self.table._db.executesql(sql, placeholders=[match])]
+
+    DDL = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5(%(columns)s, "
+        "content='%(table)s', content_rowid='id', prefix='2 3');",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_ai AFTER INSERT ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(rowid, %(columns)s) VALUES (new.id, %(new)s); END;",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_ad AFTER DELETE ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(%(fts)s, rowid, %(columns)s) "
+        "VALUES ('delete', old.id, %(old)s); END;",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_au AFTER UPDATE ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(%(fts)s, rowid, %(columns)s) "
+        "VALUES ('delete', old.id, %(old)s); "
+        "INSERT INTO %(fts)s(rowid, %(columns)s) VALUES (new.id, %(new)s); END;",
+    ]
+
+
+indexes = {"memory": {}, "fts5": {}}
+
+
+@on_commit("search")
+def apply_changes(changes):
+    """the (method, args) changes to the memory indexes of a committed transaction"""
+    for method, args in changes:
+        method(*args)
+
+
+def register_index(table, fieldnames):
+    """create the index for table and keep it in sync from the table hooks"""
+    index = indexes["memory"][table._tablename] = PrefixIndex(table, fieldnames)
+
+    def changed(method, *args):
+        #  not built yet, but another thread could build it without these
+        #  rows before the commit: invalidate it then
+        if index.built_on is None:
+            method, args = index.invalidate, ()
+            if pending("search", list)[-1:] == [(method, args)]:
+                return
+        pending("search", list).append((method, args))
+
+    def after_update(s, fields):
+        if not any(name in fields for name in index.fieldnames):
+            return
+        if index.built_on is None:
+            return changed(index.invalidate)
+        fields = [table[name] for name in index.fieldnames]
+        for row in db(s.query).select(table.id, *fields):
+            changed(index.add, row.id, row)
+
+    def before_delete(s):
+        if index.built_on is None:
+            return changed(index.invalidate)
+        for row in db(s.query).select(table.id):
+            changed(index.remove, row.id)
+
+    table._after_insert.append(lambda f, i: changed(index.add, i, f))
+    table._after_update.append(after_update)
+    table._before_delete.append(before_delete)
+    return index
+
+
+def register_fts_index(table, fieldnames):
+    """create the FTS5 index for table when SEARCH_BACKEND is "fts5" on SQLite"""
+    if settings.SEARCH_BACKEND != "fts5" or table._db._dbname != "sqlite":
+        return None
+    index = FtsIndex(table, fieldnames)
+    try:
+        if startup.MIGRATE:
+            index.setup()
+    except Exception as e:
+        logger.warning("FTS5 index for %s not available: %s", table._tablename, e)
+        return None
+    indexes["fts5"][table._tablename] = index
+    return index
+
+
+def build_when_served():
+    """
+    build the memory indexes as py4web loads the app with the production
+    profile, instead of during the first search
+    """
+    if settings.SEARCH_BACKEND != "memory" or startup.PROFILE != "production":
+        return
+    if startup.served():
+        for index in indexes["memory"].values():
+            index.ensure_built()
+
+
+def get_index(tablename, fieldnames=None):
+    """the index of tablename for SEARCH_BACKEND, if it covers fieldnames"""
+    index = indexes.get(settings.SEARCH_BACKEND, {}).get(tablename)
+    if index and fieldnames and set(fieldnames) != set(index.fieldnames):
+        return None
+    return index
+
+
+def rebuild_indexes():
+    """rebuild every index of the configured backend, returns their names"""
+    rebuilt = []
+    for tablename, index in indexes.get(settings.SEARCH_BACKEND, {}).items():
+        index.build()
+        rebuilt.append(tablename)
+    return rebuilt
+
+
+def select_ranked(table, ids, query=None, fields=None):
+    """the rows of table with the given ids, in the same order"""
+    if not ids:
+        return []
+    subquery = table.id.belongs(ids)
+    if query is not None:
+        subquery &= query
+    rows = {row.id: row for row in db(subquery).select(*(fields or []))}
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+
+def invalidate(tablename):
+    index = indexes["memory"].get(tablename)
+    if index:
+        index.invalidate()
@@ -16,9 +16,122 @@ APP_NAME = os.path.split(APP_FOLDER)[-1]
 #               and is the store location for SQLite databases
 DB_FOLDER = required_folder(APP_FOLDER, "databases")
 DB_URI = "sqlite://storage.db"
-DB_POOL_SIZE = 1
+# DB_POOL_SIZE: connections kept open for reuse by the request threads (and
+#   the job workers), about the number of threads serving requests; SQLite
+#   connections are pooled too, see database.py
+DB_POOL_SIZE = 10
 DB_MIGRATE = True
 DB_FAKE_MIGRATE = False  # maybe?
+# STARTUP_PROFILE: what the app checks when it starts (see startup.py)
+#   "development" - DB_MIGRATE compares every table with databases/*.table
+#   "production"  - only when the models changed since the last migration,
+#                   and builds the memory search indexes before serving
+STARTUP_PROFILE = "development"
+
+# DB_SQLITE_PRAGMAS: applied to every new SQLite connection (see database.py),
+# {} keeps the SQLite defaults
+#   journal_mode=WAL     readers and the writer no longer block each other
+#   synchronous=NORMAL   no fsync per commit in WAL mode, still corruption safe
+#   cache_size           pages cached per connection, negative = KiB
+#   mmap_size            bytes of the database read through a memory map
+#   busy_timeout         ms a statement waits for a lock before failing
+#   temp_store=MEMORY    sorts and temporary tables in memory
+# DB_BUSY_RETRIES: times a write transaction failing with "database is locked"
+# is rolled back and run again
+DB_SQLITE_PRAGMAS = dict(
+    journal_mode="WAL",
+    synchronous="NORMAL",
+    cache_size=-20000,
+    mmap_size=256 * 1024 * 1024,
+    busy_timeout=5000,
+    temp_store="MEMORY",
+)
+DB_BUSY_RETRIES = 3
+
+# ORDER_TOTAL_MODE: how order_line writes keep order.total in sync
+#   "delta"     - add the price difference to order.total (one UPDATE per order)
+#   "aggregate" - re-SUM all the lines of the affected orders
+ORDER_TOTAL_MODE = "delta"
+
+# SEARCH_BACKEND: index used by the autocomplete searches (see search.py)
+#   "memory" - in-process word prefix index
+#   "fts5"   - SQLite FTS5 tables kept in sync by triggers (sqlite only)
+#   None     - LIKE '%term%' queries
+# SEARCH_INDEX_TTL (seconds) rebuilds the memory index periodically to pick
+# up writes from other processes, 0 = never
+SEARCH_BACKEND = "memory"
+SEARCH_INDEX_TTL = 0
+
+# rows per page of autocomplete results, more are loaded on demand
+AUTOCOMPLETE_LIMIT = 15
+
+# PRODUCT_EXCLUSION: how the LIKE product autocomplete skips the products
+# already on the order
+#   "ids"       - NOT IN the (already fetched) list of their ids
+#   "anti_join" - LEFT JOIN order_line ... WHERE order_line.id IS NULL
+PRODUCT_EXCLUSION = "ids"
+
+# seconds rendered autocomplete fragments stay in common.cache (see
+# fragments.py), writes in this process invalidate them earlier; 0 = off
+FRAGMENT_CACHE_TTL = 300
+
+# seconds the labels shown by the autocomplete widgets for their current
+# value are shared across requests (see labels.py); 0 = per request only
+LABEL_CACHE_TTL = 300
+
+# GRID_PAGING: how the grids page through their rows (see paging.py)
+#   "keyset" - seek from the last row shown, cost independent of the page
+#   "offset" - py4web LIMIT/OFFSET pages with an exact COUNT(*)
+# GRID_COUNT_TTL (seconds) caches the row total shown by keyset grids,
+# writes in this process refresh it earlier; 0 = count on every page
+GRID_PAGING = "keyset"
+GRID_COUNT_TTL = 60
+
+# seconds the per customer/per order counts and totals shown by the grids
+# stay in common.cache (see aggregates.py), writes in this process
+# invalidate them earlier; 0 = off
+AGGREGATE_CACHE_TTL = 300
+
+# FRAGMENT_ETAGS: the customer_orders, order_lines and autocomplete fragments
+# send ETags made of the data_version counters of what they show, and answer
+# 304 Not Modified to the requests that already have it (see versions.py)
+FRAGMENT_ETAGS = True
+
+# seconds between full rebuilds of the customer_summary table by the
+# rebuild-summaries job (see tasks.py and summaries.py), 0 = never
+SUMMARY_REBUILD_INTERVAL = 24 * 3600
+
+# product price changes touching at most REPRICE_INLINE_LINES order lines
+# reprice them in the same transaction, bigger ones queue a reprice-lines
+# job (see repricing.py); None = always inline. The lines of every order are
+# repriced, old ones included
+REPRICE_INLINE_LINES = 1000
+
+# rows read per query by the streaming csv/json exports (see export.py)
+EXPORT_CHUNK_SIZE = 2000
+
+# background jobs (see jobs.py)
+# JOBS_WORKERS: worker threads started in the web process when py4web loads
+#   the app, 0 = only run by "commands worker" processes (then the periodic
+#   jobs, e.g. rebuild-summaries, need one running)
+# JOBS_POLL_INTERVAL: seconds an idle worker waits before looking again
+# JOBS_MAX_ATTEMPTS: runs of a failing job before it is marked failed
+# JOBS_RETRY_BACKOFF: seconds before the first retry, doubled at each one
+# JOBS_TIMEOUT: seconds after which a running job is assumed lost and requeued
+# JOBS_METRICS_WINDOW: seconds of finished jobs the throughput is computed on
+JOBS_WORKERS = 1
+JOBS_POLL_INTERVAL = 1
+JOBS_MAX_ATTEMPTS = 3
+JOBS_RETRY_BACKOFF = 5
+JOBS_TIMEOUT = 3600
+JOBS_METRICS_WINDOW = 300
+
+# per request query instrumentation (see instrumentation.py)
+# QUERY_REPEAT_THRESHOLD: same statement shape this many times = possible N+1
+# SLOW_QUERY_MS: statements slower than this are logged
+INSTRUMENTATION = True
+QUERY_REPEAT_THRESHOLD = 5
+SLOW_QUERY_MS = 100
 
 # location where static files are stored:
 STATIC_FOLDER = required_folder(APP_FOLDER, "static")
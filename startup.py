@@ -0,0 +1,101 @@
+"""
+Startup profile and timings
+
+With DB_MIGRATE every start compares each table with its databases/*.table
+file, creates the indexes, ... even when nothing changed since the last
+start. With STARTUP_PROFILE = "production" the app fingerprints what defines
+its schema (the SCHEMA_SOURCES, the pydal and py4web versions, DB_URI) and
+connects with migrate=False when the fingerprint is the one the last
+migrating start wrote to DB_FOLDER/schema.fingerprint. Any change of those
+migrates again, and writes the new fingerprint.
+
+mark() records how long each phase of the startup took, they are logged (at
+info level) once the app is loaded and printed by
+
+    python -m apps.htmx_demo.commands startup-report [--budget 1.0]
+"""
+
+import hashlib
+import logging
+import os
+import time
+
+import py4web
+import pydal
+from py4web import action
+
+from . import settings
+
+#  the files defining tables, or settings they depend on
+SCHEMA_SOURCES = ["common.py", "models.py", "settings.py", "settings_private.py"]
+FINGERPRINT_FILE = os.path.join(settings.DB_FOLDER, "schema.fingerprint")
+
+#  (phase, seconds) in startup order
+phases = []
+_last = time.perf_counter()
+
+
+def mark(phase):
+    """record the time spent since the previous mark as phase"""
+    global _last
+    now = time.perf_counter()
+    phases.append((phase, now - _last))
+    _last = now
+
+
+def report():
+    lines = ["%-14s %8.1f ms" % (phase, seconds * 1000) for phase, seconds in phases]
+    lines.append(
+        "%-14s %8.1f ms" % ("total", sum(seconds for _, seconds in phases) * 1000)
+    )
+    return "\n".join(lines)
+
+
+def served():
+    """
+    True when py4web loads the app (its reloader sets action.app_name), not
+    when commands.py or a script imports it
+    """
+    return action.app_name == settings.APP_NAME
+
+
+def log_report():
+    logger = logging.getLogger("py4web:" + settings.APP_NAME)
+    logger.info("%s started (%s profile)\n%s", settings.APP_NAME, PROFILE, report())
+
+
+def fingerprint():
+    """hash of what the database schema depends on"""
+    digest = hashlib.sha1()
+    for value in (settings.DB_URI, pydal.__version__, py4web.__version__):
+        digest.update(str(value).encode() + b"\0")
+    for name in SCHEMA_SOURCES:
+        path = os.path.join(settings.APP_FOLDER, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def schema_unchanged():
+    """True when the last migrating start had the same fingerprint"""
+    try:
+        with open(FINGERPRINT_FILE) as f:
+            return f.read().strip() == fingerprint()
+    except OSError:
+        return False
+
+
+def schema_migrated():
+    """write the fingerprint, once a migrating start is done"""
+    if PROFILE != "production" or not MIGRATE:
+        return
+    temp = FINGERPRINT_FILE + ".tmp"
+    with open(temp, "w") as f:
+        f.write(fingerprint())
+    os.replace(temp, FINGERPRINT_FILE)
+
+
+PROFILE = settings.STARTUP_PROFILE
+#  the migrate flag of the DAL, and whether the models create their indexes
+MIGRATE = settings.DB_MIGRATE and not (PROFILE == "production" and schema_unchanged())
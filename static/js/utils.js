@@ -373,8 +373,25 @@ Q.handle_flash = function() {
     }    
 };
 
+// Moves from an autocomplete search input (data-autocomplete="#results-select")
+// to its results on arrow down, one delegated handler for all the widgets,
+// including the ones swapped in by htmx
+Q.handle_autocomplete_keys = function () {
+    document.addEventListener('keydown', function (event) {
+        var input = event.target;
+        if (event.key !== 'ArrowDown' || !input.dataset || !input.dataset.autocomplete) return;
+        var results = document.querySelector(input.dataset.autocomplete);
+        if (results) {
+            event.preventDefault();
+            results.focus();
+            results.selectedIndex = 0;
+        }
+    });
+};
+
 Q.handle_components();
 Q.handle_flash();
+Q.handle_autocomplete_keys();
 Q('input[type=text].type-list-string').forEach(function(elem){Q.tags_input(elem);});
 Q('input[type=text].type-list-integer').forEach(function(elem){Q.tags_input(elem, {regex:/[-+]?[\d]+/});});
 Q('input[name=password],input[name=new_password]').forEach(Q.score_input);
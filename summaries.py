@@ -0,0 +1,143 @@
+"""
+Maintenance of the materialized customer_summary table
+
+One row per customer with its order_count, lifetime_total (the sum of the
+order totals) and last_order_id, so the customers grid can show, sort and
+filter by revenue reading one row per customer instead of aggregating their
+orders.
+
+The order hooks keep it in sync incrementally: an insert adds one order, a
+total change adds the difference, deletes and orders moved to another
+customer re-aggregate just the customers involved. Writes that bypass the
+hooks are fixed by rebuild_customer_summaries(), run periodically by the
+task in tasks.py or with
+
+    python -m apps.htmx_demo.commands rebuild-summaries
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from .common import db
+from .totals import as_decimal
+
+
+def summarize(customer_ids=None):
+    """{customer id: (order_count, lifetime_total, last_order_id)}"""
+    count, total, last = db.order.id.count(), db.order.total.sum(), db.order.id.max()
+    query = db.customer.id > 0
+    if customer_ids is not None:
+        query = db.customer.id.belongs(customer_ids)
+    rows = db(query).select(
+        db.customer.id,
+        count,
+        total,
+        last,
+        left=db.order.on(db.order.customer == db.customer.id),
+        groupby=db.customer.id,
+    )
+    return {
+        row.customer.id: (row[count], as_decimal(row[total]), row[last]) for row in rows
+    }
+
+
+def recompute_customer_summaries(customer_ids):
+    """re-aggregate the summaries of the given customers with one grouped query"""
+    customer_ids = {int(customer_id) for customer_id in customer_ids if customer_id}
+    if not customer_ids:
+        return
+    summary = db.customer_summary
+    for customer_id, (count, total, last) in summarize(customer_ids).items():
+        summary.update_or_insert(
+            summary.customer == customer_id,
+            customer=customer_id,
+            order_count=count,
+            lifetime_total=total,
+            last_order_id=last,
+        )
+
+
+def apply_summary_delta(customer_id, orders=0, total=0, last_order_id=None):
+    """add orders and total to the summary of customer_id with one UPDATE"""
+    total = as_decimal(total)
+    if not customer_id or not (orders or total or last_order_id):
+        return
+    summary = db.customer_summary
+    fields = dict(
+        order_count=summary.order_count.coalesce_zero() + orders,
+        lifetime_total=summary.lifetime_total.coalesce_zero() + total,
+    )
+    if last_order_id:
+        fields["last_order_id"] = last_order_id
+    if not db(summary.customer == customer_id).update(**fields):
+        #  no summary yet (created before the table, or by raw SQL)
+        recompute_customer_summaries([customer_id])
+
+
+def rebuild_customer_summaries():
+    """recompute every customer summary, returns the number of customers"""
+    summaries = summarize()
+    db.customer_summary.truncate()
+    db.customer_summary.bulk_insert(
+        [
+            dict(
+                customer=customer_id,
+                order_count=count,
+                lifetime_total=total,
+                last_order_id=last,
+            )
+            for customer_id, (count, total, last) in summaries.items()
+        ]
+    )
+    return len(summaries)
+
+
+def track_customer_summaries():
+    """keep customer_summary in sync from the customer and order hooks"""
+
+    def order_after_insert(fields, order_id):
+        apply_summary_delta(
+            fields.get("customer"), 1, fields.get("total"), last_order_id=order_id
+        )
+
+    def order_before_update(s, fields):
+        if "customer" in fields or "total" in fields:
+            rows = db(s.query).select(db.order.id, db.order.customer, db.order.total)
+            s.summary_rows = {row.id: row for row in rows}
+
+    def order_after_update(s, fields):
+        before = getattr(s, "summary_rows", None)
+        if not before:
+            return
+        rows = db(db.order.id.belongs(before)).select(
+            db.order.id, db.order.customer, db.order.total
+        )
+        moved, deltas = set(), defaultdict(Decimal)
+        for row in rows:
+            old = before[row.id]
+            if row.customer != old.customer:
+                moved.update([row.customer, old.customer])
+            else:
+                deltas[row.customer] += as_decimal(row.total) - as_decimal(old.total)
+        for customer_id, delta in deltas.items():
+            if customer_id not in moved:
+                apply_summary_delta(customer_id, total=delta)
+        recompute_customer_summaries(moved)
+
+    def order_before_delete(s):
+        rows = db(s.query).select(db.order.customer, distinct=True)
+        s.summary_customers = [row.customer for row in rows]
+
+    def order_after_delete(s):
+        recompute_customer_summaries(getattr(s, "summary_customers", []))
+
+    db.customer._after_insert.append(
+        lambda f, i: db.customer_summary.insert(
+            customer=i, order_count=0, lifetime_total=0
+        )
+    )
+    db.order._after_insert.append(order_after_insert)
+    db.order._before_update.append(order_before_update)
+    db.order._after_update.append(order_after_update)
+    db.order._before_delete.append(order_before_delete)
+    db.order._after_delete.append(order_after_delete)
@@ -1,36 +1,62 @@
 """
-To use celery tasks:
-1) pip install -U "celery[redis]"
-2) In settings.py:
-   USE_CELERY = True
-   CELERY_BROKER = "redis://localhost:6379/0"
-3) Start "redis-server"
-4) Start "celery -A apps.{appname}.tasks beat"
-5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
+Background jobs of the app, run off the request thread by the workers of
+jobs.py (threads of the web process and/or "commands worker" processes):
 
+    from .jobs import enqueue
+    job_id = enqueue("rebuild-totals", verify_only=True)
+
+the status of a job is polled by the htmx fragment of the jobs/status action.
+
+A handler gets the keyword arguments given to enqueue and returns a json
+serializable result; raising makes the job retry with backoff.
 """
 
-from .common import settings, scheduler, db, Field
-
-
-# example of task that needs db access
-@scheduler.task
-def my_task():
-    try:
-        # this task will be executed in its own thread, connect to db
-        db._adapter.reconnect()
-        # do something here
-        db.commit()
-    except:
-        # rollback on failure
-        db.rollback()
-
-
-# run my_task very 10 seconds
-scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
-        "args": (),
-    },
-}
+import os
+
+from .common import settings, db
+from .jobs import job_handler
+from . import totals, importer, summaries, repricing
+
+
+@job_handler("rebuild-totals")
+def rebuild_totals(verify_only=False):
+    mismatched = totals.rebuild_order_totals(verify_only=verify_only)
+    return dict(
+        verify_only=verify_only,
+        mismatched=len(mismatched),
+        orders=[order_id for order_id, stored, actual in mismatched[:100]],
+    )
+
+
+@job_handler("import-products")
+def import_products(path, batch_size=1000, remove=True):
+    """import the csv at path, removed once imported unless remove is False"""
+    with open(path, newline="", encoding="utf8") as f:
+        stats = importer.import_products(f, batch_size=batch_size)
+    if remove:
+        os.unlink(path)
+    return dict(
+        rows=stats.rows,
+        inserted=stats.inserted,
+        updated=stats.updated,
+        unchanged=stats.unchanged,
+        rejected=stats.rejected,
+        rejected_lines=stats.rejected_lines,
+        seconds=round(stats.seconds, 3),
+    )
+
+
+@job_handler("rebuild-summaries", every=settings.SUMMARY_REBUILD_INTERVAL)
+def rebuild_summaries():
+    return dict(customers=summaries.rebuild_customer_summaries())
+
+
+@job_handler("reprice-lines")
+def reprice_lines(product_ids=None):
+    """reprice the lines of product_ids, of the whole catalog when None"""
+    lines, orders = repricing.reprice(product_ids)
+    return dict(
+        products=len(product_ids) if product_ids is not None else "all",
+        lines=lines,
+        orders=orders,
+    )
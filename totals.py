@@ -0,0 +1,118 @@
+"""
+Maintenance of the denormalized order.total column
+
+settings.ORDER_TOTAL_MODE selects how the order_line hooks keep it in sync:
+- "delta":     the price difference of the changed lines is applied with a
+               single UPDATE order SET total = total + ? per affected order,
+               bypassing the order hooks (models.apply_order_deltas does
+               what they maintain once for all the orders)
+- "aggregate": the lines of every affected order are summed again
+"""
+
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+
+from .common import db, settings
+
+CENTS = Decimal("0.01")
+
+
+def delta_mode():
+    return settings.ORDER_TOTAL_MODE == "delta"
+
+
+def as_decimal(value):
+    if value is None or value == "":
+        return Decimal(0)
+    value = value if isinstance(value, Decimal) else Decimal(str(value))
+    return value.quantize(CENTS)
+
+
+def line_price(quantity, unit_price):
+    """
+    the price of an order line, rounded half up to cents so that the stored
+    price and the delta applied to order.total are the same number
+    """
+    if not quantity or not unit_price:
+        return Decimal(0)
+    price = as_decimal(quantity) * as_decimal(unit_price)
+    return price.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def apply_total_delta(order_id, delta):
+    """add delta to order.total with one atomic UPDATE, without the order hooks"""
+    delta = as_decimal(delta)
+    if not order_id or not delta:
+        return
+    db(db.order.id == order_id).update_naive(
+        total=db.order.total.coalesce_zero() + delta
+    )
+
+
+def line_deltas(rows, fields=None):
+    """
+    compute the per order change of the total when the order_line rows are
+    updated with fields (or deleted when fields is None)
+    """
+    deltas = defaultdict(Decimal)
+    for row in rows:
+        deltas[row.order] -= as_decimal(row.price)
+        if fields is not None:
+            new_order = fields.get("order", row.order)
+            new_price = fields["price"] if "price" in fields else row.price
+            deltas[new_order] += as_decimal(new_price)
+    return deltas
+
+
+def deleted_line_deltas(s):
+    """per order change of the total when the order_line set s is deleted"""
+    total = db.order_line.price.sum()
+    rows = db(s.query).select(db.order_line.order, total, groupby=db.order_line.order)
+    return {row.order_line.order: -as_decimal(row[total]) for row in rows}
+
+
+def recompute_order_totals(order_ids, exclude=None):
+    """
+    set order.total of the given orders from the SUM of their lines with one
+    grouped query, ignoring the lines matching the exclude query (the ones
+    about to be deleted)
+    """
+    order_ids = {int(order_id) for order_id in order_ids if order_id}
+    if not order_ids:
+        return
+    query = db.order_line.order.belongs(order_ids)
+    if exclude is not None:
+        query &= ~exclude
+    total = db.order_line.price.sum()
+    rows = db(query).select(db.order_line.order, total, groupby=db.order_line.order)
+    totals = {row.order_line.order: row[total] for row in rows}
+    for order_id in order_ids:
+        db(db.order.id == order_id).update(total=totals.get(order_id) or 0)
+
+
+def rebuild_order_totals(verify_only=False):
+    """
+    reconcile every order.total against the SUM of its lines using one grouped
+    query; returns the list of (order_id, stored, actual) that did not match,
+    and fixes them unless verify_only is set
+    """
+    total = db.order_line.price.sum()
+    rows = db(db.order.id > 0).select(
+        db.order.id,
+        db.order.total,
+        total,
+        left=db.order_line.on(db.order_line.order == db.order.id),
+        groupby=db.order.id | db.order.total,
+    )
+    mismatched = []
+    for row in rows:
+        stored = as_decimal(row.order.total)
+        actual = as_decimal(row[total])
+        if stored != actual:
+            mismatched.append((row.order.id, stored, actual))
+
+    if not verify_only:
+        for order_id, stored, actual in mismatched:
+            db(db.order.id == order_id).update(total=actual)
+
+    return mismatched
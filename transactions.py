@@ -0,0 +1,67 @@
+"""
+Work done once a transaction commits
+
+The per process caches (fragments.py generations, aggregates.py versions,
+the search.py memory index) must not change while the write that makes them
+stale is still uncommitted: a request of another thread could read the old
+rows in between and cache them under the new generation. So the write hooks
+only collect what they would change in pending(name), per thread like the
+transactions, and the on_commit(name) function applies it when the adapter
+commits; a rollback drops it.
+
+Until then the transaction itself must not read those caches, uncommitted()
+tells which items it already changed.
+"""
+
+import threading
+
+#  name -> function applying the items collected for name by a transaction
+handlers = {}
+_transaction = threading.local()
+
+
+def on_commit(name):
+    """decorator registering the function called with the name items of a commit"""
+
+    def decorator(func):
+        handlers[name] = func
+        return func
+
+    return decorator
+
+
+def pending(name, factory=set):
+    """
+    the name items (a set, or what factory returns) collected by the
+    transaction of this thread, for the on_commit(name) function
+    """
+    items = getattr(_transaction, "items", None)
+    if items is None:
+        items = _transaction.items = {}
+    if name not in items:
+        items[name] = factory()
+    return items[name]
+
+
+def uncommitted(name):
+    """the name items collected by the transaction of this thread so far"""
+    return (getattr(_transaction, "items", None) or {}).get(name, frozenset())
+
+
+def track_transactions(adapter):
+    """apply the pending items when adapter commits, drop them on rollback"""
+    commit, rollback = adapter.commit, adapter.rollback
+
+    def committed():
+        result = commit()
+        items, _transaction.items = getattr(_transaction, "items", None), None
+        for name, collected in (items or {}).items():
+            if collected:
+                handlers[name](collected)
+        return result
+
+    def rolled_back():
+        _transaction.items = None
+        return rollback()
+
+    adapter.commit, adapter.rollback = committed, rolled_back
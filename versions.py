@@ -0,0 +1,148 @@
+"""
+Data version counters and conditional GETs of the htmx fragments
+
+The data_version table holds one counter per name, bumped in the
+transaction of the writes it stands for:
+
+- "<table>/<parent id>" the rows of table under one parent, e.g. order/5
+  for the orders of customer 5 and order_line/7 for the lines of order 7,
+  bumped with the aggregates of aggregates.py by the track_parents hooks
+- "<table>" any row of a table registered with track_writes()
+
+Unlike the per process generations of fragments.py and aggregates.py they
+are shared by every process using the database, and roll back with the
+writes. The fragments decorated with conditional_get() send an ETag made of
+the versions of the data they show, the request and the app build; a
+request whose If-None-Match matches it gets a 304 Not Modified after a
+single read of the counters, before the action runs. Cache-Control:
+no-cache makes the browsers (and htmx requests) revalidate every time.
+"""
+
+import functools
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+import py4web
+from py4web import request, response, HTTP
+
+from .common import db, settings
+
+_batch = threading.local()
+_tracked = set()
+
+
+def build():
+    """hash of the py4web version, app code and templates, as loaded"""
+    digest = hashlib.sha1(py4web.__version__.encode())
+    for folder, dirs, files in os.walk(settings.APP_FOLDER):
+        dirs[:] = sorted(name for name in dirs if name not in ("databases", "static"))
+        for name in sorted(files):
+            if name.endswith((".py", ".html")):
+                path = os.path.join(folder, name)
+                relative = os.path.relpath(path, settings.APP_FOLDER)
+                digest.update(("%s %s" % (relative, os.path.getmtime(path))).encode())
+    return digest.hexdigest()
+
+
+BUILD = build()
+
+
+def bump(*names):
+    """increment the versions of names, in the current transaction"""
+    names = sorted({str(name) for name in names if name is not None})
+    if not names:
+        return
+    if getattr(_batch, "names", None) is not None:
+        _batch.names.update(names)
+        return
+    table = db.data_version
+    db.executesql(
+        "INSERT INTO %(table)s (%(name)s, %(version)s) VALUES %(values)s "
+        "ON CONFLICT (%(name)s) DO UPDATE SET %(version)s = %(table)s.%(version)s + 1;"
+        % dict(
+            table=table._rname,
+            name=table.name._rname,
+            version=table.version._rname,
+            values=", ".join(
+                "(%s, 1)" % db._adapter.represent(name, "string") for name in names
+            ),
+        )
+    )
+
+
+@contextmanager
+def batched():
+    """bump the versions of the names bumped in the block once, at its end"""
+    if getattr(_batch, "names", None) is not None:
+        yield
+        return
+    _batch.names = set()
+    try:
+        yield
+        names = _batch.names
+    finally:
+        _batch.names = None
+    bump(*names)
+
+
+def read(*names):
+    """the versions of names, with a single query"""
+    table = db.data_version
+    rows = db(table.name.belongs(names)).select(table.name, table.version)
+    versions = {row.name: row.version for row in rows}
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def track_writes(table):
+    """bump the version of table on every insert, update and delete"""
+    tablename = table._tablename
+    _tracked.add(tablename)
+    table._after_insert.append(lambda f, i: bump(tablename))
+    table._after_update.append(lambda s, f: bump(tablename))
+    table._after_delete.append(lambda s: bump(tablename))
+
+
+def tracked(tablename):
+    """True when the writes to tablename bump its version"""
+    return tablename in _tracked
+
+
+def etag(names):
+    """the ETag of the current request showing the data versioned by names"""
+    digest = hashlib.sha1(BUILD.encode())
+    digest.update(request.fullpath.encode() + b"?" + request.query_string.encode())
+    for name, version in zip(names, read(*names)):
+        digest.update(("\0%s=%s" % (name, version)).encode())
+    return '"%s"' % digest.hexdigest()[:20]
+
+
+def conditional_get(names_of):
+    """
+    decorator answering 304 Not Modified to the GET requests whose
+    If-None-Match is the etag() of the names returned by names_of(), none
+    when they are not cacheable, or running the action and sending its ETag
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.FRAGMENT_ETAGS or request.method != "GET":
+                return func(*args, **kwargs)
+            names = names_of()
+            if not names:
+                return func(*args, **kwargs)
+            tag = etag(names)
+            headers = {"ETag": tag, "Cache-Control": "private, no-cache"}
+            #  proxies compressing the response send it back as a weak W/"..."
+            if_none_match = request.headers.get("If-None-Match", "")
+            matches = [v.strip().replace("W/", "", 1) for v in if_none_match.split(",")]
+            if tag in matches:
+                raise HTTP(304, headers=headers)
+            response.headers.update(headers)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator